@@ -0,0 +1,446 @@
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from aiohttp import web
+
+import monitor
+from monitor import KeywordClassifier
+
+
+# 旧版关键词中的大小写混合条目永远匹配不到，对比时统一转小写
+LEGACY_KEYWORDS = tuple(
+    [keyword.lower() for keyword in keywords]
+    for keywords in (
+        KeywordClassifier.OUT_OF_STOCK_KEYWORDS,
+        KeywordClassifier.IN_STOCK_KEYWORDS,
+        KeywordClassifier.ORDER_INDICATORS
+    )
+)
+
+
+def legacy_classify(content):
+    """旧版判断方式：三组关键词分别用 any() 全文扫描"""
+    out_of_stock_keywords, in_stock_keywords, order_indicators = LEGACY_KEYWORDS
+    is_out_of_stock = any(keyword in content for keyword in out_of_stock_keywords)
+    is_in_stock = any(keyword in content for keyword in in_stock_keywords)
+    has_order_form = any(indicator in content for indicator in order_indicators)
+
+    if not is_out_of_stock and (is_in_stock or has_order_form) and len(content) > 1000:
+        return True, None
+    elif is_out_of_stock:
+        return False, None
+    else:
+        return False, "无法确定库存状态"
+
+
+def generate_store_page(size, in_stock, seed=0):
+    """生成一个类似 WHMCS 商店页面的测试页面"""
+    rng = random.Random(seed)
+    fragments = [
+        '<div class="panel panel-default"><div class="panel-body">',
+        '<script>window.dataLayer=window.dataLayer||[];function gtag(){dataLayer.push(arguments);}</script>',
+        '<style>.navbar{background:#222;color:#fff}.footer a{color:#999}</style>',
+        '<li class="nav-item"><a href="/knowledgebase">Knowledgebase</a></li>',
+        '<span class="cpu">2 vCPU</span><span class="ram">2048 MB RAM</span>',
+        '<span class="disk">40 GB SSD</span><span class="bw">2 TB Bandwidth</span>',
+        '<p>KVM virtualization, full root access, 1 Gbps port, IPv4 + /64 IPv6.</p>',
+        '<a href="/announcements">Announcements</a><a href="/serverstatus.php">Network Status</a>',
+        '<div class="footer">Copyright &copy; Example Hosting LLC. All Rights Reserved.</div>',
+    ]
+    product = (
+        '<div class="product"><header><span>KVM VPS 2G</span></header>'
+        '<div class="product-pricing"><span class="price">$29.89</span> USD Annually</div>'
+        + ('<a href="cart.php?a=add&pid=42" class="btn btn-success">Order Now</a>' if in_stock
+           else '<span class="qty">0 Available</span><div class="btn btn-danger">Out of Stock</div>')
+        + '</div>'
+    )
+    parts = []
+    length = 0
+    product_at = rng.randint(0, max(0, size - 2000))
+    placed = False
+    while length < size:
+        if not placed and length >= product_at:
+            parts.append(product)
+            placed = True
+            length += len(product)
+        fragment = rng.choice(fragments)
+        parts.append(fragment)
+        length += len(fragment)
+    if not placed:
+        parts.append(product)
+    return ''.join(parts).lower()
+
+
+def time_call(func, repeat):
+    """多次调用取中位耗时（毫秒）"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def overlap_cases(keywords):
+    """相互重叠或包含的关键词组合，如 "in stock" + "stock: 0" -> "in stock: 0"
+
+    返回 (文本, 文本中应命中的关键词)
+    """
+    cases = []
+    for first in keywords:
+        for second in keywords:
+            if first == second:
+                continue
+            if second in first:
+                cases.append((first, (first, second)))
+            for size in range(1, min(len(first), len(second))):
+                if first[-size:] == second[:size]:
+                    cases.append((first + second[size:], (first, second)))
+    return cases
+
+
+def stream_classify(classifier, content, chunk_size=monitor.PageScanner.CHUNK_SIZE):
+    """按线上的方式分块流式扫描页面（已转小写）得出判定"""
+    data = content.encode('utf-8')
+    scanner = monitor.PageScanner(classifier)
+    for start in range(0, len(data), chunk_size):
+        if scanner.feed(data[start:start + chunk_size]):
+            break
+    scanner.finish()
+    return classifier.decide(scanner.categories, len(content))
+
+
+def check_overlaps(classifier):
+    """回归检查：重叠关键词的类别都要命中，整页判定和任意分块位置的流式判定都与旧版 any() 一致，返回不一致的数量"""
+    failures = 0
+    padding = ' ' * 1024  # 超过 1000 字符，有货判定才会生效
+    for text, keywords in overlap_cases(list(classifier.keyword_categories)):
+        expected = set().union(*(classifier.keyword_categories[keyword] for keyword in keywords))
+        missing = expected - classifier.find_categories(text)
+        content = padding + text + padding
+        legacy_result = legacy_classify(content)
+        results = {classifier.classify(content)}
+        # 分块边界落在关键词内部的每个位置
+        for split in range(len(padding) + 1, len(padding) + len(text.encode('utf-8'))):
+            results.add(stream_classify(classifier, content, split))
+        if missing or results != {legacy_result}:
+            failures += 1
+            print(f"不一致: {text!r} 缺少类别 {sorted(missing)} 判定 {sorted(results)} 旧版 {legacy_result}")
+    return failures
+
+
+def bench_classifier(args):
+    """对比旧版 any() 扫描、整页判定和线上使用的流式扫描，以及用于跳过重复判定的内容指纹，先检查重叠关键词的回归用例"""
+    classifier = KeywordClassifier()
+    cache = monitor.ResponseCache()
+    cases = len(overlap_cases(list(classifier.keyword_categories)))
+    failures = check_overlaps(classifier)
+    print(f"重叠关键词用例: {cases} 个，不一致 {failures} 个\n")
+
+    pages = []
+    for path in args.pages:
+        with open(path, 'rb') as f:
+            pages.append((path, f.read().decode('utf-8', 'replace').lower()))
+    if not pages:
+        for size in args.sizes:
+            pages.append((f"synthetic {size // 1024}KB 有货", generate_store_page(size, True)))
+            pages.append((f"synthetic {size // 1024}KB 无货", generate_store_page(size, False)))
+
+    print(f"{'页面':<28}{'大小':>10}{'any() ms':>12}{'整页判定 ms':>14}{'流式扫描 ms':>14}{'指纹 ms':>10}  判定")
+    for name, content in pages:
+        legacy_result = legacy_classify(content)
+        results = {classifier.classify(content), stream_classify(classifier, content)}
+        legacy_ms = time_call(lambda: legacy_classify(content), args.repeat)
+        classify_ms = time_call(lambda: classifier.classify(content), args.repeat)
+        stream_ms = time_call(lambda: stream_classify(classifier, content), args.repeat)
+        fingerprint_ms = time_call(lambda: cache.fingerprint(content), args.repeat)
+        verdict = '一致' if results == {legacy_result} else f"不一致 {legacy_result} != {sorted(results)}"
+        print(f"{name[-28:]:<28}{len(content):>10}{legacy_ms:>12.3f}{classify_ms:>14.3f}{stream_ms:>14.3f}{fingerprint_ms:>10.3f}  {verdict}")
+    if failures:
+        raise SystemExit(1)
+
+
+def load_corpus(corpus_dir, page_size):
+    """读取保存的商店页面（*.html），没有时生成有货/无货两种页面"""
+    pages = []
+    if corpus_dir:
+        for path in sorted(glob.glob(os.path.join(corpus_dir, '*.html'))):
+            with open(path, 'rb') as f:
+                pages.append(f.read())
+    if not pages:
+        pages = [
+            generate_store_page(page_size, True, seed=1).encode('utf-8'),
+            generate_store_page(page_size, False, seed=2).encode('utf-8')
+        ]
+    return pages
+
+
+CHALLENGE_PAGE = (
+    b'<!DOCTYPE html><html><head><title>Just a moment...</title></head><body>'
+    b'<h1>Checking if the site connection is secure</h1>' + b'<!-- padding -->' * 32 + b'</body></html>'
+)
+
+
+def serve_corpus(port, corpus_dir, page_size, latency, jitter, error_rate, ready):
+    """本地模拟的商店页面服务器（在子进程中运行，不占用被测进程的事件循环）
+
+    /p/<n> 按序号轮流返回语料中的页面，/cf/<n> 返回 Cloudflare 挑战页面
+    """
+    pages = load_corpus(corpus_dir, page_size)
+    rng = random.Random(0)
+
+    async def handle_page(request):
+        if latency or jitter:
+            await asyncio.sleep(max(0.0, latency + rng.uniform(-jitter, jitter)))
+        if rng.random() < error_rate:
+            return web.Response(status=500, text='Internal Server Error')
+        index = int(request.match_info['index'])
+        return web.Response(body=pages[index % len(pages)], content_type='text/html', charset='utf-8')
+
+    async def handle_challenge(request):
+        if latency or jitter:
+            await asyncio.sleep(max(0.0, latency + rng.uniform(-jitter, jitter)))
+        return web.Response(
+            status=503, body=CHALLENGE_PAGE, content_type='text/html',
+            headers={'Server': 'cloudflare', 'cf-mitigated': 'challenge'}
+        )
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/p/{index}', handle_page)
+        app.router.add_get('/cf/{index}', handle_challenge)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port, backlog=4096).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+def build_urls(port, count, challenge_rate):
+    """生成监控列表；挑战页面放在 localhost 主机上，只让该主机切换到 cloudscraper"""
+    urls = {}
+    challenge_every = int(1 / challenge_rate) if challenge_rate > 0 else 0
+    for index in range(count):
+        if challenge_every and index % challenge_every == 0:
+            url = f"http://localhost:{port}/cf/{index}"
+        else:
+            url = f"http://127.0.0.1:{port}/p/{index}"
+        urls[str(index + 1)] = {"名称": f"Bench {index + 1}", "URL": url, "配置": ""}
+    return urls
+
+
+class LoopLagProbe:
+    """定期 sleep 并测量实际唤醒的延迟，估计事件循环阻塞时间"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    def summary(self):
+        if not self.lags:
+            return 0.0, 0.0
+        lags = sorted(self.lags)
+        return lags[int(len(lags) * 0.99) - 1 if len(lags) >= 100 else -1] * 1000, lags[-1] * 1000
+
+
+class StubBot:
+    """代替 Telegram Bot，只计数不发送"""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text):
+        self.sent += 1
+
+
+class StubUpdater:
+    running = True
+
+    async def stop(self):
+        self.running = False
+
+
+class StubApplication:
+    def __init__(self):
+        self.bot = StubBot()
+        self.updater = StubUpdater()
+
+    async def stop(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class BenchMonitor(monitor.VPSMonitor):
+    """Telegram 替换为空实现的监控程序，启动检查完成时通知基准测试"""
+
+    def __init__(self):
+        super().__init__()
+        self.startup_done = asyncio.Event()
+        # 通知不经过真实 API，去掉发送频率限制
+        self.notifier.chat_interval = 0
+        self.notifier.global_rate = float('inf')
+
+    async def initialize(self):
+        self.app = StubApplication()
+
+    async def send_telegram_notification(self, message, digest=False, chats=None):
+        await super().send_telegram_notification(message, digest, chats)
+        if message.startswith("✅ 启动检查完成"):
+            self.startup_done.set()
+
+
+def run_scenario(mode, port, count, args):
+    """在独立子进程中运行一个场景，返回统计结果（峰值内存只包含该场景）"""
+    with tempfile.TemporaryDirectory(prefix='vpsmonitor-bench-') as workdir:
+        os.chdir(workdir)
+        write_scenario_files(port, count, args)
+        logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+        return asyncio.run(measure(mode, args))
+
+
+def write_scenario_files(port, count, args):
+    """在当前目录写入基准测试用的 config.json 和 urls.json"""
+    with open('config.json', 'w', encoding='utf-8') as f:
+        json.dump({
+            "bot_token": "bench",
+            "chat_id": "bench",
+            "check_interval": args.cycle_timeout,
+            "max_workers": args.workers,
+            "host_limits": {"default": {"rate": 1e6, "burst": 1e6, "min_gap": 0, "max_concurrent": args.workers}},
+            "urls_reload_interval": 3600
+        }, f)
+    with open('urls.json', 'w', encoding='utf-8') as f:
+        json.dump(build_urls(port, count, args.challenge_rate), f, ensure_ascii=False)
+
+
+async def measure(mode, args):
+    probe = LoopLagProbe()
+    probe.start()
+    if mode == 'check':
+        bench = monitor.VPSMonitor()
+        urls = list(bench.load_urls())
+        start = time.perf_counter()
+        await asyncio.gather(*(bench.check_stock(url) for url in urls))
+        elapsed = time.perf_counter() - start
+        if bench.http_session:
+            await bench.http_session.close()
+        bench.executor.shutdown(wait=False, cancel_futures=True)
+        bench.state_store.close()
+    else:
+        bench = BenchMonitor()
+        urls = list(bench.load_urls())
+        start = time.perf_counter()
+        task = asyncio.create_task(bench.monitor())
+        done, _ = await asyncio.wait(
+            [task, asyncio.create_task(bench.startup_done.wait())], return_when=asyncio.FIRST_COMPLETED
+        )
+        elapsed = time.perf_counter() - start
+        if task in done:
+            task.result()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await probe.stop()
+
+    checks = {labels[0][1]: value for labels, value in bench.metrics.samples['vpsmonitor_checks'].items()}
+    lag_p99, lag_max = probe.summary()
+    return {
+        'urls': len(urls),
+        'elapsed': elapsed,
+        'checks_per_second': len(urls) / elapsed if elapsed else 0.0,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'lag_p99_ms': lag_p99,
+        'lag_max_ms': lag_max,
+        'checks': checks
+    }
+
+
+def bench_cycle(args):
+    """启动本地页面服务器，按不同规模测量 check_stock 并发检查或完整的启动检查周期"""
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve_corpus,
+        args=(args.port, args.corpus, args.page_size, args.latency, args.jitter, args.error_rate, ready),
+        daemon=True
+    )
+    server.start()
+    try:
+        if not ready.wait(30):
+            raise RuntimeError("本地页面服务器启动失败")
+        print(f"{'模式':<8}{'URL数':>8}{'耗时 s':>10}{'检查/秒':>10}{'峰值内存 MB':>14}{'循环延迟 p99/max ms':>22}  结果")
+        for count in args.counts:
+            for mode in args.modes:
+                # 每个场景使用全新的子进程，峰值内存互不影响
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    result = pool.submit(run_scenario, mode, args.port, count, args).result()
+                checks = ', '.join(f"{name} {value}" for name, value in sorted(result['checks'].items()))
+                print(
+                    f"{mode:<8}{result['urls']:>8}{result['elapsed']:>10.2f}{result['checks_per_second']:>10.1f}"
+                    f"{result['peak_rss_mb']:>14.1f}{result['lag_p99_ms']:>12.1f} / {result['lag_max_ms']:<7.1f}  {checks}"
+                )
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VPSMonitor 性能基准测试")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    classifier_parser = subparsers.add_parser('classifier', help="关键词分类器微基准")
+    classifier_parser.add_argument('pages', nargs='*', help="保存的商店页面HTML文件，不指定则使用生成的页面")
+    classifier_parser.add_argument('--sizes', type=int, nargs='+', default=[64 * 1024, 512 * 1024, 4 * 1024 * 1024],
+                                   help="生成页面的大小（字节）")
+    classifier_parser.add_argument('--repeat', type=int, default=20, help="每个页面重复次数")
+    classifier_parser.set_defaults(func=bench_classifier)
+
+    cycle_parser = subparsers.add_parser('cycle', help="用本地模拟的商店页面测量检查吞吐量")
+    cycle_parser.add_argument('--counts', type=int, nargs='+', default=[100, 1000, 10000], help="监控的URL数量")
+    cycle_parser.add_argument('--modes', nargs='+', choices=['check', 'monitor'], default=['check', 'monitor'],
+                              help="check 并发调用 check_stock，monitor 运行完整的启动检查周期")
+    cycle_parser.add_argument('--corpus', help="保存的商店页面目录（*.html），不指定则使用生成的页面")
+    cycle_parser.add_argument('--page-size', type=int, default=64 * 1024, help="生成页面的大小（字节）")
+    cycle_parser.add_argument('--latency', type=float, default=0.05, help="服务器响应延迟（秒）")
+    cycle_parser.add_argument('--jitter', type=float, default=0.02, help="响应延迟的随机浮动（秒）")
+    cycle_parser.add_argument('--error-rate', type=float, default=0.0, help="返回 HTTP 500 的比例")
+    cycle_parser.add_argument('--challenge-rate', type=float, default=0.0, help="返回 Cloudflare 挑战页面的URL比例")
+    cycle_parser.add_argument('--workers', type=int, default=10, help="max_workers")
+    cycle_parser.add_argument('--cycle-timeout', type=int, default=3600, help="每批检查的时间预算（秒）")
+    cycle_parser.add_argument('--port', type=int, default=18765, help="本地服务器端口")
+    cycle_parser.add_argument('--verbose', action='store_true', help="输出监控程序的日志")
+    cycle_parser.set_defaults(func=bench_cycle)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,9 @@ NC='\033[0m'
 # 配置文件
 CONFIG_FILE="config.json"
 URLS_FILE="urls.json"
+URLS_JOURNAL="urls.json.journal"  # 机器人添加/删除商品的日志，定期合并进 urls.json
 MONITOR_LOG="monitor.log"
+MONITOR_OUT="monitor.out"  # 程序自身写 monitor.log 并负责轮转，这里只保存启动失败等终端输出
 INIT_MARK=".initialized"
 
 # 检查监控状态
@@ -78,7 +80,7 @@ start_monitor() {
 
     echo -e "${YELLOW}正在启动监控程序...${NC}"
     source venv/bin/activate
-    nohup python3 monitor.py >> "$MONITOR_LOG" 2>&1 &
+    nohup python3 monitor.py > "$MONITOR_OUT" 2>&1 &
     sleep 3
     
     if pgrep -f "python3 monitor.py" > /dev/null; then
@@ -86,7 +88,8 @@ start_monitor() {
     else
         echo -e "${RED}监控程序启动失败${NC}"
         echo -e "${YELLOW}查看错误日志...${NC}"
-        tail -n 5 "$MONITOR_LOG"
+        tail -n 5 "$MONITOR_OUT"
+        [ -f "$MONITOR_LOG" ] && tail -n 5 "$MONITOR_LOG"
     fi
 }
 
@@ -109,6 +112,34 @@ stop_monitor() {
     fi
 }
 
+# 把机器人尚未合并的修改写进 urls.json，之后菜单读到的是完整的列表
+sync_urls() {
+    local pid=$(pgrep -o -f "python3 monitor.py")
+    if [ -n "$pid" ]; then
+        # 通知机器人立即合并日志，并暂停定期合并，等待菜单写入
+        kill -USR1 "$pid"
+        for _ in $(seq 1 20); do
+            [ -s "$URLS_JOURNAL" ] || return 0
+            sleep 0.5
+        done
+        echo -e "${RED}监控程序未能及时合并监控列表，请稍后再试${NC}"
+        return 1
+    fi
+    [ -s "$URLS_JOURNAL" ] || return 0
+    # 监控程序未运行：由脚本按顺序重放日志（与 URLRegistry.apply 相同：同一个URL只保留一个条目）
+    if [ ! -s "$URLS_FILE" ]; then
+        echo '{}' > "$URLS_FILE"
+    fi
+    if ! jq --slurpfile journal "$URLS_JOURNAL" 'reduce $journal[] as $r (.;
+            with_entries(select(.key != $r.id and ($r.op == "del" or .value.URL != $r.entry.URL)))
+            + (if $r.op == "put" then {($r.id): $r.entry} else {} end))' "$URLS_FILE" > "$URLS_FILE.tmp"; then
+        rm -f "$URLS_FILE.tmp"
+        echo -e "${RED}无法读取 $URLS_JOURNAL，请启动监控程序后再修改${NC}"
+        return 1
+    fi
+    mv "$URLS_FILE.tmp" "$URLS_FILE" && : > "$URLS_JOURNAL"
+}
+
 # 添加URL
 add_url() {
     echo -e "\n${YELLOW}请输入产品名称: ${NC}"
@@ -130,13 +161,15 @@ add_url() {
         return
     fi
 
+    sync_urls || return
+
     # 如果文件不存在或为空，创建一个空的JSON对象
     if [ ! -f "$URLS_FILE" ] || [ ! -s "$URLS_FILE" ]; then
         echo '{}' > "$URLS_FILE"
     fi
 
-    # 生成唯一ID（使用时间戳）
-    id=$(date +%s)
+    # 生成新ID（沿用机器人的编号方式：现有最大数字ID加一）
+    id=$(jq -r '[keys[] | select(test("^[0-9]+$")) | tonumber] | max // 0 | . + 1' "$URLS_FILE")
     
     # 构建JSON数据
     json_data="{\"$id\": {\"名称\": \"$product_name\", \"URL\": \"$product_url\""
@@ -153,6 +186,8 @@ add_url() {
 
 # 删除URL
 delete_url() {
+    sync_urls || return
+
     if [ ! -s "$URLS_FILE" ]; then
         echo -e "${YELLOW}监控列表为空${NC}"
         return
@@ -163,7 +198,10 @@ delete_url() {
     
     echo -e "\n${YELLOW}请输入要删除的ID：${NC}"
     read -r id
-    
+
+    # 输入期间机器人可能又有修改，删除前再合并一次
+    sync_urls || return
+
     # 检查ID是否存在
     if ! jq -e "has(\"$id\")" "$URLS_FILE" > /dev/null; then
         echo -e "${RED}ID不存在${NC}"
@@ -184,6 +222,8 @@ delete_url() {
 
 # 显示所有URL
 show_urls() {
+    sync_urls || return
+
     if [ ! -s "$URLS_FILE" ] || [ "$(jq 'length' "$URLS_FILE")" = "0" ]; then
         echo -e "${YELLOW}监控列表为空${NC}"
         return
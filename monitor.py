@@ -2,12 +2,14 @@ import asyncio
 import cloudscraper
 import time
 import logging
+import logging.handlers
 import json
 import os
 import random
 import asyncio
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -18,16 +20,2358 @@ from telegram.ext import (
     filters
 )
 import urllib.parse
-import brotli
+# 不直接调用：请求头声明了 br 压缩，aiohttp 和 cloudscraper 只在安装了 brotli 时才能解压，缺少时启动即报错
+import brotli  # noqa: F401
+import aiohttp
+from aiohttp import web
+import functools
+import contextlib
+import hashlib
+import re
+import codecs
+import html.parser
+import sqlite3
+import threading
+import heapq
+import array
+import struct
+import multiprocessing
+import signal
+import socket
+import sys
+import traceback
+import queue
+import gzip
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # 状态定义
 CHOOSING, TYPING_URL = range(2)
 
+class HostScheduler:
+    """按主机（netloc）限流：令牌桶 + 最小请求间隔 + 并发上限"""
+
+    # 默认限制：每秒补充令牌数、桶容量、两次请求最小间隔（秒）、同时请求数
+    DEFAULT_LIMITS = {
+        'rate': 0.5,
+        'burst': 2,
+        'min_gap': 2.0,
+        'max_concurrent': 2
+    }
+
+    def __init__(self, host_limits=None):
+        host_limits = dict(host_limits or {})
+        self.default_limits = {**self.DEFAULT_LIMITS, **host_limits.pop('default', {})}
+        self.host_overrides = {host.lower(): limits for host, limits in host_limits.items()}
+        self.hosts = {}
+
+    def get_host(self, url):
+        """获取URL所属主机的限流状态，不存在则创建"""
+        host = urllib.parse.urlparse(url).netloc.lower()
+        state = self.hosts.get(host)
+        if state is None:
+            limits = {**self.default_limits, **self.host_overrides.get(host, {})}
+            state = {
+                'limits': limits,
+                'tokens': float(limits['burst']),
+                'updated': time.monotonic(),
+                'last_request': None,
+                'lock': asyncio.Lock(),
+                'semaphore': asyncio.Semaphore(max(1, int(limits['max_concurrent'])))
+            }
+            self.hosts[host] = state
+        return state
+
+    async def wait_turn(self, state):
+        """等待令牌和最小间隔都满足后再放行"""
+        limits = state['limits']
+        while True:
+            now = time.monotonic()
+            # 补充令牌
+            state['tokens'] = min(
+                float(limits['burst']),
+                state['tokens'] + (now - state['updated']) * limits['rate']
+            )
+            state['updated'] = now
+
+            wait = 0.0
+            if state['last_request'] is not None:
+                wait = max(wait, state['last_request'] + limits['min_gap'] - now)
+            if state['tokens'] < 1:
+                wait = max(wait, (1 - state['tokens']) / limits['rate'] if limits['rate'] > 0 else limits['min_gap'])
+            if wait <= 0:
+                state['tokens'] -= 1
+                state['last_request'] = now
+                return
+            await asyncio.sleep(wait)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url):
+        """占用一个主机请求名额，不同主机之间互不影响"""
+        state = self.get_host(url)
+        async with state['semaphore']:
+            # 同一主机的等待者按顺序排队领取令牌
+            async with state['lock']:
+                await self.wait_turn(state)
+            yield
+
+class HostCircuitBreaker:
+    """按主机熔断：连续失败达到阈值后暂停检查该主机（open），退避时间到后只放行一个页面试探（half_open），
+    试探成功恢复正常（closed），失败则退避时间加倍"""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, threshold=3, backoff=60, max_backoff=1800):
+        self.threshold = max(1, threshold)  # 连续失败多少个页面后熔断
+        self.backoff = backoff  # 首次熔断的暂停时间（秒）
+        self.max_backoff = max_backoff
+        self.hosts = {}
+
+    def get_host(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = {'state': self.CLOSED, 'failures': 0, 'backoff': 0, 'retry_at': 0.0, 'last_error': '', 'probe': 0}
+            self.hosts[host] = state
+        return state
+
+    def admit(self, host, now):
+        """是否可以请求该主机，返回 (是否放行, 不放行时下次可以尝试的时间)；熔断到期后只放行一次试探"""
+        state = self.hosts.get(host)
+        if state is None or state['state'] == self.CLOSED:
+            return True, None
+        if now >= state['retry_at']:
+            # 熔断到期放行试探；试探请求迟迟没有结果时，到期后再放行一个，其它页面不会一直被挡住
+            state['state'] = self.HALF_OPEN
+            state['retry_at'] = now + self.backoff
+            state['probe'] += 1
+            return True, None
+        return False, state['retry_at']
+
+    def release(self, host, probe, now):
+        """放行的试探没有得到结果（排队时被取消、由其它节点检查等）时交还名额，不计为失败
+
+        probe 为放行时的试探序号，之后又放行了新的试探时不做处理
+        """
+        state = self.hosts.get(host)
+        if state is not None and state['state'] == self.HALF_OPEN and state['probe'] == probe:
+            state['state'] = self.OPEN
+            state['retry_at'] = now
+
+    def record(self, host, ok, error, now):
+        """记录一次页面请求的结果，返回 opened（开始熔断）、recovered（恢复）或 None"""
+        state = self.get_host(host)
+        if ok:
+            recovered = state['state'] != self.CLOSED
+            state.update({'state': self.CLOSED, 'failures': 0, 'backoff': 0})
+            return 'recovered' if recovered else None
+        state['last_error'] = error
+        if state['state'] == self.CLOSED:
+            state['failures'] += 1
+            if state['failures'] < self.threshold:
+                return None
+            state['backoff'] = self.backoff
+            event = 'opened'
+        else:
+            # 试探失败（或熔断前已发出的请求陆续失败），退避时间加倍
+            if state['state'] == self.HALF_OPEN:
+                state['backoff'] = min(state['backoff'] * 2, self.max_backoff)
+            event = None
+        state['state'] = self.OPEN
+        state['retry_at'] = now + state['backoff'] * random.uniform(0.8, 1.2)
+        return event
+
+    def is_open(self, host):
+        state = self.hosts.get(host)
+        return state is not None and state['state'] != self.CLOSED
+
+    def open_hosts(self):
+        """熔断中的主机 {主机: 状态}"""
+        return {host: state for host, state in self.hosts.items() if state['state'] != self.CLOSED}
+
+class KeywordClassifier:
+    """关键词库存判断：每类关键词命中任一个即停止查找该类别，只需要命中的类别和页面长度即可得出结论"""
+
+    # 缺货关键词
+    OUT_OF_STOCK_KEYWORDS = [
+        'sold out', 'out of stock', '缺货', '售罄', '补货中',
+        'currently unavailable', 'not available', '暂时缺货',
+        'temporarily out of stock', '已售完', '库存不足',
+        'out-of-stock', 'unavailable', '无货', '断货',
+        'not in stock', 'no stock', '无库存', 'stock: 0',
+        'sorry', 'Sorry, this item is currently unavailable'
+    ]
+
+    # 有货关键词
+    IN_STOCK_KEYWORDS = [
+        'add to bag', 'buy now', '立即购买', '加入购物车',
+        'in stock', '有货', '现货', 'available', 'order now',
+        'purchase', 'checkout', '订购', '下单', '继续', '繼續',
+        'configure', 'select options', 'stock: 1', 'stock: 2',
+        'stock: 3', 'stock: 4', 'stock: 5', 'configure now', 'Continue'
+    ]
+
+    # 订单表单和价格选择器（通常表示可以购买）
+    ORDER_INDICATORS = [
+        'form', 'price', 'quantity', 'payment', 'checkout',
+        'cart', 'billing', '价格', '数量', '支付',
+        'order form', 'purchase form', 'configure now'
+    ]
+
+    def __init__(self, out_of_stock_keywords=None, in_stock_keywords=None, order_indicators=None):
+        groups = (
+            ('out_of_stock', out_of_stock_keywords or self.OUT_OF_STOCK_KEYWORDS),
+            ('in_stock', in_stock_keywords or self.IN_STOCK_KEYWORDS),
+            ('order_form', order_indicators or self.ORDER_INDICATORS)
+        )
+        # 页面内容会先转小写，关键词也统一转小写，否则大小写混合的关键词永远匹配不到
+        self.keyword_categories = {}
+        self.category_keywords = {}
+        for category, keywords in groups:
+            for keyword in keywords:
+                self.keyword_categories.setdefault(keyword.lower(), set()).add(category)
+                self.category_keywords.setdefault(category, []).append(keyword.lower())
+
+        # 流式扫描时保留的上一块末尾长度，保证跨分块边界的关键词也能命中
+        self.max_keyword_length = max(len(keyword) for keyword in self.keyword_categories)
+
+    def find_categories(self, content, categories=None):
+        """命中的关键词类别，每个类别命中任一关键词即停止查找；categories 限定只查找这些类别"""
+        return {
+            category for category, keywords in self.category_keywords.items()
+            if (categories is None or category in categories) and any(keyword in content for keyword in keywords)
+        }
+
+    def decide(self, categories, length):
+        """根据命中类别和页面长度得出库存判定"""
+        is_out_of_stock = 'out_of_stock' in categories
+        is_in_stock = 'in_stock' in categories
+        has_order_form = 'order_form' in categories
+
+        if not is_out_of_stock and (is_in_stock or has_order_form) and length > 1000:
+            return True, None
+        elif is_out_of_stock:
+            return False, None
+        else:
+            return False, "无法确定库存状态"
+
+    def classify(self, content):
+        """判断页面内容（已转小写）的库存状态"""
+        return self.decide(self.find_categories(content), len(content))
+
+class PageScanner:
+    """流式读取页面：增量解码、跨分块匹配关键词，达到字节上限或得出明确结论时提前结束"""
+
+    CHUNK_SIZE = 64 * 1024
+    CLOUDFLARE_MARKERS = ('just a moment', 'checking if the site connection is secure')
+    META_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+    def __init__(self, classifier, encoding=None, max_bytes=0, early_verdict=True, scan_keywords=True):
+        self.classifier = classifier
+        self.encoding = encoding
+        self.max_bytes = max_bytes
+        self.early_verdict = early_verdict
+        self.scan_keywords = scan_keywords  # 所有商品都设置了选择器时只需检查 Cloudflare 特征
+        self.decoder = None
+        self.parts = []
+        self.categories = set()
+        self.tail = ''
+        self.length = 0
+        self.bytes_read = 0
+        self.truncated = False  # 达到字节上限
+        self.stopped_early = False  # 已得出明确结论，未读完页面
+        self.cloudflare = False
+        self.text = ''
+        self.decode_time = 0.0  # 解码耗时（秒）
+        self.scan_time = 0.0  # 关键词匹配耗时（秒）
+
+    @staticmethod
+    def header_encoding(content_type):
+        """从 Content-Type 中取出 charset"""
+        if not content_type:
+            return None
+        for param in content_type.split(';')[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.lower() == 'charset' and value:
+                return value.strip('"\' ')
+        return None
+
+    def create_decoder(self, first_chunk):
+        """按响应头或页面 meta 中的编码创建增量解码器，无法识别时按 utf-8 解码"""
+        encoding = self.encoding
+        if not encoding:
+            match = self.META_CHARSET_PATTERN.search(first_chunk[:4096])
+            if match:
+                encoding = match.group(1).decode('ascii', 'ignore')
+        try:
+            return codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+        except LookupError:
+            return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def feed(self, chunk, final=False):
+        """处理一个数据块，返回 True 表示可以停止读取"""
+        if self.max_bytes and self.bytes_read + len(chunk) > self.max_bytes:
+            chunk = chunk[:self.max_bytes - self.bytes_read]
+            self.truncated = True
+        self.bytes_read += len(chunk)
+        started = time.perf_counter()
+        if self.decoder is None:
+            self.decoder = self.create_decoder(chunk)
+        text = self.decoder.decode(chunk, final).lower()
+        decoded = time.perf_counter()
+        self.decode_time += decoded - started
+        if text:
+            self.scan(text)
+            self.scan_time += time.perf_counter() - decoded
+        return self.truncated or self.stopped_early or self.cloudflare
+
+    def scan(self, text):
+        """在 tail + 新文本上匹配，保证跨分块边界的关键词也能命中"""
+        self.parts.append(text)
+        self.length += len(text)
+        window = self.tail + text
+        if self.scan_keywords and self.early_verdict and 'out_of_stock' not in self.categories:
+            # 下载过程中只查找能提前结束下载的缺货关键词，其它类别在 finish 中对整个页面查找一次
+            self.categories |= self.classifier.find_categories(window, ('out_of_stock',))
+
+        if any(marker in window for marker in self.CLOUDFLARE_MARKERS):
+            self.cloudflare = True
+
+        keep = self.classifier.max_keyword_length - 1
+        self.tail = window[-keep:] if keep > 0 else ''
+
+        # 缺货关键词出现即可确定结论（判定规则中缺货优先），内容过短时继续读取
+        if self.early_verdict and self.length >= 100 and 'out_of_stock' in self.categories:
+            self.stopped_early = True
+
+    def finish(self):
+        """结束读取，合并页面文本"""
+        if self.decoder is not None and not (self.truncated or self.stopped_early or self.cloudflare):
+            remaining = self.decoder.decode(b'', True).lower()
+            if remaining:
+                self.scan(remaining)
+        self.text = ''.join(self.parts)
+        self.parts = []
+        # 判定规则中缺货优先，已命中缺货关键词时其它类别不影响结论；下载时已查找过缺货关键词的不再重复查找
+        if self.scan_keywords and 'out_of_stock' not in self.categories:
+            started = time.perf_counter()
+            searched = ('out_of_stock',) if self.early_verdict else ()
+            self.categories |= self.classifier.find_categories(
+                self.text, [category for category in self.classifier.category_keywords if category not in searched]
+            )
+            self.scan_time += time.perf_counter() - started
+        return self
+
+class Selector:
+    """编译后的CSS选择器或XPath（常用子集），在流式解析的标签上逐步匹配
+
+    CSS 支持 tag、#id、.class、[attr]、[attr=value]，以及后代（空格）和子元素（>）组合；
+    XPath 支持 //tag、/tag、*，以及 [@attr]、[@attr='value']、[contains(@attr,'value')] 条件。
+    """
+
+    CSS_STEP = re.compile(r'([\w*-]*)((?:[#.][\w-]+|\[[^\]]+\])*)$')
+    CSS_PART = re.compile(r'#([\w-]+)|\.([\w-]+)|\[\s*([\w-]+)\s*(?:=\s*["\']?([^"\'\]]*)["\']?\s*)?\]')
+    XPATH_STEP = re.compile(r'(//|/)([\w*-]+)((?:\[[^\]]+\])*)')
+    XPATH_PREDICATE = re.compile(
+        r'\[\s*(?:@([\w-]+)\s*(?:=\s*["\']([^"\']*)["\'])?|contains\(\s*@([\w-]+)\s*,\s*["\']([^"\']*)["\']\s*\))\s*\]'
+    )
+
+    def __init__(self, source):
+        self.source = source
+        # 每一步为 (是否要求直接子元素, 标签, 属性条件)，属性条件为 (属性, 比较方式, 值)
+        self.steps = self.parse_xpath(source) if source.startswith('/') else self.parse_css(source)
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def compile(cls, source):
+        """编译选择器并缓存（页面内容已转小写，选择器同样按小写匹配）"""
+        return cls(source.strip().lower())
+
+    @classmethod
+    def parse_css(cls, source):
+        steps = []
+        child = False
+        for token in re.sub(r'\s*>\s*', ' > ', source).split():
+            if token == '>':
+                if not steps or child:
+                    raise ValueError(f"无法解析选择器：{source}")
+                child = True
+                continue
+            match = cls.CSS_STEP.match(token)
+            if not match:
+                raise ValueError(f"无法解析选择器：{source}")
+            conditions = []
+            for id_value, class_value, attr, value in cls.CSS_PART.findall(match.group(2)):
+                if id_value:
+                    conditions.append(('id', 'eq', id_value))
+                elif class_value:
+                    conditions.append(('class', 'word', class_value))
+                else:
+                    conditions.append((attr, 'eq' if value else 'has', value))
+            tag = match.group(1) or '*'
+            steps.append((child, tag, tuple(conditions)))
+            child = False
+        if not steps or child:
+            raise ValueError(f"无法解析选择器：{source}")
+        return tuple(steps)
+
+    @classmethod
+    def parse_xpath(cls, source):
+        steps = []
+        position = 0
+        for match in cls.XPATH_STEP.finditer(source):
+            if match.start() != position:
+                break
+            position = match.end()
+            conditions = []
+            predicates = match.group(3)
+            consumed = 0
+            for predicate in cls.XPATH_PREDICATE.finditer(predicates):
+                if predicate.start() != consumed:
+                    raise ValueError(f"不支持的XPath条件：{source}")
+                consumed = predicate.end()
+                attr, value, contains_attr, contains_value = predicate.groups()
+                if contains_attr:
+                    conditions.append((contains_attr, 'contains', contains_value))
+                else:
+                    conditions.append((attr, 'has' if value is None else 'eq', value or ''))
+            if consumed != len(predicates):
+                raise ValueError(f"不支持的XPath条件：{source}")
+            # 开头的单个 / 也按文档任意位置处理，页面通常不是完整的 XML 树
+            child = match.group(1) == '/' and bool(steps)
+            steps.append((child, match.group(2), tuple(conditions)))
+        if not steps or position != len(source):
+            raise ValueError(f"无法解析XPath：{source}")
+        return tuple(steps)
+
+    def step_matches(self, index, tag, attrs):
+        """第 index 步是否匹配该标签"""
+        _, step_tag, conditions = self.steps[index]
+        if step_tag != '*' and step_tag != tag:
+            return False
+        for attr, mode, value in conditions:
+            actual = attrs.get(attr)
+            if actual is None:
+                return False
+            if mode == 'eq' and actual != value:
+                return False
+            if mode == 'word' and value not in actual.split():
+                return False
+            if mode == 'contains' and value not in actual:
+                return False
+        return True
+
+class ScopedExtractor(html.parser.HTMLParser):
+    """单次解析页面，取出每个选择器匹配元素内的文本，跳过 script/style"""
+
+    VOID_TAGS = frozenset((
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'
+    ))
+    SKIPPED_TAGS = frozenset(('script', 'style', 'noscript', 'template'))
+
+    def __init__(self, selectors):
+        super().__init__(convert_charrefs=True)
+        self.selectors = list(selectors)
+        self.texts = [[] for _ in self.selectors]
+        self.matched = [False] * len(self.selectors)
+        # 每个打开的标签：(标签, 在此处完成的步数, 祖先及自身完成的步数, 在此处开始截取的选择器)
+        root = (None, frozenset(), frozenset((index, 0) for index in range(len(self.selectors))), ())
+        self.stack = [root]
+        self.capturing = [0] * len(self.selectors)  # 各选择器当前所在的匹配元素层数
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        parent = self.stack[-1]
+        attr_map = {name: value or '' for name, value in attrs}
+        exact = set()
+        for index, selector in enumerate(self.selectors):
+            for step in range(len(selector.steps)):
+                child = selector.steps[step][0]
+                reachable = parent[1] if child else parent[2]
+                if (index, step) in reachable and selector.step_matches(step, tag, attr_map):
+                    exact.add((index, step + 1))
+        completed = tuple(
+            index for index, selector in enumerate(self.selectors) if (index, len(selector.steps)) in exact
+        )
+        for index in completed:
+            self.matched[index] = True
+            self.capturing[index] += 1
+        if tag in self.SKIPPED_TAGS:
+            self.skipping += 1
+        if tag in self.VOID_TAGS:
+            for index in completed:
+                self.capturing[index] -= 1
+            return
+        # 第一步可以匹配任意层级，后代组合从父元素继承
+        exact = frozenset(exact)
+        self.stack.append((tag, exact, parent[2] | exact, completed))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # 容忍未闭合的标签：弹出到最近的同名标签为止
+        for depth in range(len(self.stack) - 1, 0, -1):
+            if self.stack[depth][0] == tag:
+                break
+        else:
+            return
+        while len(self.stack) > depth:
+            closed = self.stack.pop()
+            for index in closed[3]:
+                self.capturing[index] -= 1
+            if closed[0] in self.SKIPPED_TAGS:
+                self.skipping -= 1
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        for index, depth in enumerate(self.capturing):
+            if depth:
+                self.texts[index].append(data)
+
+    def extract(self, content):
+        """解析页面，返回每个选择器的文本，未匹配的选择器为 None"""
+        self.feed(content)
+        self.close()
+        return [' '.join(parts) if matched else None for parts, matched in zip(self.texts, self.matched)]
+
+class StockProbe:
+    """平台专用的轻量库存探测，子类按平台覆盖识别和判断方法"""
+
+    name = 'generic'
+    json_endpoint = False  # 是否先请求更小的 JSON 接口
+    redirect_probe = False  # 是否关闭自动跳转，根据加入购物车后的跳转判断
+
+    def matches_url(self, parsed):
+        """根据URL识别平台"""
+        return False
+
+    def matches_response(self, headers, content):
+        """根据首个完整响应（响应头和小写的页面内容）识别平台"""
+        return False
+
+    def json_url(self, url):
+        """JSON 接口地址，不适用时返回 None"""
+        return None
+
+    def interpret_json(self, url, data):
+        """根据 JSON 数据判断库存，无法确定时返回 None"""
+        return None
+
+    def interpret_redirect(self, location):
+        """根据跳转地址判断库存，无法确定时返回 None"""
+        return None
+
+class ShopifyProbe(StockProbe):
+    """Shopify 类商店：/products/<handle>.js 返回商品和各规格的 available"""
+
+    name = 'shopify'
+    json_endpoint = True
+    PRODUCT_PATTERN = re.compile(r'^(.*/products/[^/.?#]+)')
+
+    def matches_response(self, headers, content):
+        return 'X-ShopId' in headers or 'X-Shopify-Stage' in headers or 'cdn.shopify.com' in content
+
+    def json_url(self, url):
+        parsed = urllib.parse.urlparse(url)
+        match = self.PRODUCT_PATTERN.match(parsed.path)
+        if not match:
+            return None
+        return urllib.parse.urlunparse(parsed._replace(path=match.group(1) + '.js', query='', fragment=''))
+
+    def interpret_json(self, url, data):
+        if not isinstance(data, dict) or 'available' not in data:
+            return None
+        # URL 指定了规格时只看该规格
+        variant = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('variant', [None])[0]
+        if variant:
+            for item in data.get('variants', []):
+                if str(item.get('id')) == variant:
+                    return bool(item.get('available')), None
+            return None
+        return bool(data['available']), None
+
+class WHMCSProbe(StockProbe):
+    """WHMCS：cart.php?a=add&pid= 有货时直接跳转到配置页，无货时停留在购物车页面显示缺货"""
+
+    name = 'whmcs'
+    redirect_probe = True
+    IN_STOCK_STEPS = ('a=confproduct', 'a=confdomains', 'a=view', 'a=checkout')
+
+    def matches_url(self, parsed):
+        query = urllib.parse.parse_qs(parsed.query)
+        return parsed.path.endswith('cart.php') and query.get('a') == ['add'] and 'pid' in query
+
+    def matches_response(self, headers, content):
+        return 'whmcs' in content or 'WHMCS' in headers.get('Set-Cookie', '')
+
+    def interpret_redirect(self, location):
+        if any(step in location for step in self.IN_STOCK_STEPS):
+            return True, None
+        return None
+
+class HostBillProbe(StockProbe):
+    """HostBill：加入购物车的请求有货时跳转到下一步（step=），无货时停留在购物车页面"""
+
+    name = 'hostbill'
+    redirect_probe = True
+
+    def matches_url(self, parsed):
+        query = urllib.parse.parse_qs(parsed.query)
+        return (query.get('cmd') == ['cart'] or '/cart/' in parsed.query) and 'id' in query and 'action' in query
+
+    def matches_response(self, headers, content):
+        return 'hostbill' in content or 'HBSESSID' in headers.get('Set-Cookie', '')
+
+    def interpret_redirect(self, location):
+        if 'step=' in location:
+            return True, None
+        return None
+
+class ProbeRegistry:
+    """可扩展的平台探测注册表：先按URL识别，否则用首个完整响应识别，结果按主机缓存"""
+
+    def __init__(self, probes=None):
+        self.probes = list(probes) if probes is not None else [ShopifyProbe(), WHMCSProbe(), HostBillProbe()]
+        self.host_platforms = {}  # 主机 -> 平台探测（None 表示通用页面）
+
+    def register(self, probe):
+        self.probes.append(probe)
+
+    def select(self, url):
+        """该URL应使用的探测方式，未识别时返回 None"""
+        parsed = urllib.parse.urlparse(url)
+        for probe in self.probes:
+            if probe.matches_url(parsed):
+                return probe
+        return self.host_platforms.get(parsed.netloc.lower())
+
+    def learn(self, url, headers, content):
+        """用首个完整响应识别主机的平台"""
+        host = urllib.parse.urlparse(url).netloc.lower()
+        if host in self.host_platforms:
+            return
+        self.host_platforms[host] = next(
+            (probe for probe in self.probes if probe.matches_response(headers, content)), None
+        )
+
+class ResponseCache:
+    """按页面URL缓存 ETag/Last-Modified、内容指纹和各商品上次的判定结果"""
+
+    # 归一化时去掉的易变内容：CSRF token、nonce 等属性值，以及长的十六进制串
+    # 每种属性单独一个以固定前缀开头的正则，正则引擎可以直接跳到前缀处，比合成一个多选分支快得多
+    VOLATILE_ATTRIBUTE_PATTERNS = tuple(re.compile(pattern) for pattern in (
+        rb'nonce="[^"]*"',
+        rb'csrf-token="[^"]*"',
+        rb'data-cfemail="[^"]*"',
+        rb'name="(?:token|csrf[\w-]*|_token)"\s+value="[^"]*"'
+    ))
+    # 十六进制字符映射为 h、其它字节映射为 .，再用子串查找定位 32 位以上的十六进制串
+    HEX_MASK = bytes(
+        ord('h') if byte in b'0123456789abcdef' else ord('.') for byte in range(256)
+    )
+    HEX_RUN = b'h' * 32
+    HEX_RUN_END = re.compile(rb'h*')
+    # 各种空白统一映射为空格，再反复把两个空格替换成一个
+    WHITESPACE_MAP = bytes.maketrans(b'\t\n\r\x0b\x0c', b'     ')
+
+    def __init__(self):
+        self.entries = {}
+        self.changed = set()  # 内容指纹有变化的URL
+        self.stats = {
+            'not_modified': 0,  # 服务器返回304
+            'fingerprint_hits': 0,  # 页面内容未变化，跳过关键词判断
+            'misses': 0,  # 页面有变化或首次检查
+            'bytes_saved': 0  # 304命中时省下的下载字节数
+        }
+
+    def conditional_headers(self, url):
+        """生成条件请求头"""
+        entry = self.entries.get(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def fingerprint(self, content):
+        """计算归一化后页面内容（已转小写）的指纹，在线程池中调用
+
+        按 UTF-8 字节处理，2MB页面约15毫秒：去掉易变属性和长十六进制串后折叠空白。
+        全程只有整块的 bytes 操作，不产生大量小对象。
+        """
+        data = content.encode('utf-8', 'ignore')
+        for pattern in self.VOLATILE_ATTRIBUTE_PATTERNS:
+            data = pattern.sub(b'', data)
+        mask = data.translate(self.HEX_MASK)
+        parts = []
+        last = 0
+        position = mask.find(self.HEX_RUN)
+        while position != -1:
+            end = self.HEX_RUN_END.match(mask, position).end()
+            parts.append(data[last:position])
+            last = end
+            position = mask.find(self.HEX_RUN, end)
+        parts.append(data[last:])
+        normalized = b''.join(parts).translate(self.WHITESPACE_MAP)
+        # 每次替换使连续空格减半，比正则替换快得多
+        while b'  ' in normalized:
+            normalized = normalized.replace(b'  ', b' ')
+        return hashlib.sha1(normalized.strip(b' ')).hexdigest()
+
+    @staticmethod
+    def cached_results(entry, products):
+        """取出各商品上次的判定结果，有商品没有缓存结果时返回 None"""
+        if entry is None or any(product not in entry['results'] for product in products):
+            return None
+        return {product: entry['results'][product] for product in products}
+
+    def not_modified(self, url, products):
+        """服务器返回304时取出各商品上次的判定结果"""
+        results = self.cached_results(self.entries.get(url), products)
+        if results is None:
+            return None
+        self.stats['not_modified'] += 1
+        self.stats['bytes_saved'] += self.entries[url]['size']
+        return results
+
+    def lookup(self, url, fingerprint, products):
+        """内容指纹与上次相同时返回各商品上次的判定结果"""
+        entry = self.entries.get(url)
+        if entry is not None and entry['fingerprint'] == fingerprint:
+            results = self.cached_results(entry, products)
+            if results is not None:
+                self.stats['fingerprint_hits'] += 1
+                return results
+        self.stats['misses'] += 1
+        return None
+
+    def store(self, url, response_headers, fingerprint, results, size):
+        """保存本次响应的校验信息和各商品的判定结果 {商品URL: 结果}"""
+        previous = self.entries.get(url)
+        if previous is not None and previous['fingerprint'] != fingerprint:
+            self.changed.add(url)
+        self.entries[url] = {
+            'etag': response_headers.get('ETag'),
+            'last_modified': response_headers.get('Last-Modified'),
+            'fingerprint': fingerprint,
+            'results': results,
+            'size': size
+        }
+
+    def pop_changed(self, url):
+        """页面内容自上次查询以来是否有变化（用于判断页面是否频繁变动）"""
+        if url in self.changed:
+            self.changed.discard(url)
+            return True
+        return False
+
+    def remove(self, url):
+        self.entries.pop(url, None)
+        self.changed.discard(url)
+
+    def summary(self):
+        """缓存命中情况摘要"""
+        stats = self.stats
+        return (
+            f"304命中 {stats['not_modified']}，指纹命中 {stats['fingerprint_hits']}，"
+            f"未命中 {stats['misses']}，节省下载 {stats['bytes_saved'] / 1024:.1f} KB"
+        )
+
+class URLRegistry:
+    """urls.json 的内存索引：按URL和ID查找，文件变化（mtime/inode/大小）时才重新加载
+
+    修改先追加到日志文件（urls.json.journal，每行一条，写入后 fsync），定期合并成完整的
+    urls.json（临时文件 + fsync + 原子替换），增删一个商品只需写一行。所有写入都在单独的
+    线程中按顺序执行，不阻塞事件循环。合并前发现 urls.json 被菜单脚本修改时，先重新加载
+    并在新内容上重放日志，不会覆盖外部修改。菜单脚本修改前发送 SIGUSR1，先合并日志并暂停
+    定期合并，菜单看到的是完整的列表，删除的商品也不会被日志重放恢复。
+    """
+
+    COMPACT_ENTRIES = 100  # 日志达到该条数时立即合并
+    MENU_HOLD = 60  # 菜单脚本请求合并后暂停定期合并的时间（秒），直到菜单写入 urls.json
+
+    def __init__(self, path, logger, read_only=False, default_chat=None):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.logger = logger
+        self.read_only = read_only  # 只读（工作进程）：不写文件，日志变化时也重新加载
+        # 没有 订阅 字段的条目（旧数据、菜单脚本添加的条目）属于该聊天
+        self.default_chat = None if default_chat is None else str(default_chat)
+        self.by_id = {}  # ID -> 条目（与 urls.json 中的结构一致）
+        self.by_url = {}  # URL -> ID
+        self.signature = None
+        self.next_id = 1
+        self.version = 0  # 每次内容变化加一，便于使用方判断是否需要刷新缓存
+        self.pending = None  # 尚未合并进 urls.json 的日志记录，首次加载时从日志文件读取
+        self.pending_since = None  # 最早一条未合并记录的时间
+        self.compact_requested = asyncio.Event()  # 菜单脚本请求立即合并
+        self.hold_until = 0  # 在此之前不定期合并，等待菜单脚本写入
+        self.io = None if read_only else ThreadPoolExecutor(max_workers=1, thread_name_prefix='urls-io')
+
+    @staticmethod
+    def stat_signature(path):
+        """文件的 (inode, mtime, 大小)，文件不存在时返回 None"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def file_signature(self):
+        """urls.json 的签名；只读时还包含日志文件的签名"""
+        signature = self.stat_signature(self.path)
+        if self.read_only:
+            return signature, self.stat_signature(self.journal_path)
+        return signature
+
+    def refresh(self):
+        """文件有变化时重新加载，返回是否重新加载"""
+        signature = self.file_signature()
+        if signature is not None and signature == self.signature:
+            return False
+        self.load()
+        return True
+
+    def read_journal(self):
+        """读取日志文件，忽略崩溃时写了一半的最后一行（可写时顺便截掉，避免后续记录接在残行后面）"""
+        records = []
+        valid_bytes = 0
+        try:
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line.decode('utf-8')))
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        self.logger.warning("URL日志文件末尾有不完整的记录，已忽略")
+                        if not self.read_only:
+                            os.truncate(self.journal_path, valid_bytes)
+                        break
+                    valid_bytes += len(line)
+        except FileNotFoundError:
+            pass
+        return records
+
+    def load(self):
+        """从文件重建索引，并重放尚未合并的日志"""
+        signature = self.file_signature()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            self.logger.info("URL文件不存在，将创建新文件")
+            data = {}
+            if not self.read_only:
+                self.write_snapshot({}, None)
+                signature = self.file_signature()
+        except json.JSONDecodeError as e:
+            # 文件可能正在被其他程序写入，保留当前索引，下次再试
+            self.logger.error(f"加载URL文件时出错: {str(e)}")
+            return
+
+        self.by_id = {}
+        self.by_url = {}
+        for id_str, info in data.items():
+            if info.get('URL', ''):
+                self.by_id[id_str] = info
+                self.by_url[info['URL']] = id_str
+        if self.read_only or self.pending is None:
+            records = self.read_journal()
+            if not self.read_only:
+                self.pending = records
+                self.pending_since = time.monotonic() if records else None
+        else:
+            records = self.pending
+        for id_str in list(self.by_id) + [record['id'] for record in records]:
+            if id_str.isdigit():
+                self.next_id = max(self.next_id, int(id_str) + 1)
+        for record in records:
+            other = self.by_id.get(record['id'])
+            if record['op'] == 'put' and other is not None and other.get('URL') != record['entry']['URL']:
+                # 菜单脚本在合并前用了同一个ID添加其他商品：本程序的条目换一个新ID，两个商品都保留
+                new_id = self.allocate_id()
+                self.logger.warning(f"ID {record['id']} 已被菜单脚本用于其他商品，{record['entry']['URL']} 改用ID {new_id}")
+                record['id'] = new_id
+            self.apply(record)
+        self.signature = signature
+        self.version += 1
+        self.logger.info(f"成功加载 {len(self.by_url)} 个URL")
+
+    def apply(self, record):
+        """把一条日志记录应用到内存索引"""
+        id_str = record['id']
+        old = self.by_id.pop(id_str, None)
+        if old is not None and self.by_url.get(old.get('URL')) == id_str:
+            del self.by_url[old['URL']]
+        if record['op'] == 'put':
+            entry = record['entry']
+            # 同一个URL只保留一个条目
+            other = self.by_url.get(entry['URL'])
+            if other is not None:
+                self.by_id.pop(other, None)
+            self.by_id[id_str] = entry
+            self.by_url[entry['URL']] = id_str
+
+    def append_journal(self, record):
+        """追加一条日志并 fsync（在写入线程中执行）"""
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def commit(self, record):
+        """记录一次修改：立即更新内存索引，日志写入完成后返回"""
+        self.apply(record)
+        self.version += 1
+        if self.pending is None:
+            self.pending = []
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending.append(record)
+        # 提交到单线程执行器的顺序即写入顺序
+        await asyncio.get_running_loop().run_in_executor(self.io, self.append_journal, record)
+
+    def write_snapshot(self, data, expected):
+        """原子写入完整的 urls.json 并清空日志，返回新签名；文件已被外部修改时放弃并返回 None"""
+        if expected is not None and self.stat_signature(self.path) != expected:
+            return None
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        if expected is not None and self.stat_signature(self.path) != expected:
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, self.path)
+        # 目录项也要落盘，否则断电后可能仍是旧文件
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        # urls.json 已包含所有日志记录，可以清空日志
+        with open(self.journal_path, 'w', encoding='utf-8') as f:
+            os.fsync(f.fileno())
+        return self.stat_signature(self.path)
+
+    async def compact(self):
+        """把未合并的日志写进 urls.json"""
+        if not self.pending:
+            return
+        data = {id_str: dict(entry) for id_str, entry in self.by_id.items()}
+        count = len(self.pending)
+        signature = await asyncio.get_running_loop().run_in_executor(
+            self.io, self.write_snapshot, data, self.signature
+        )
+        if signature is None:
+            # 菜单脚本刚修改了文件：重新加载并重放日志，下次再合并
+            self.logger.warning("检测到 urls.json 被外部修改，已重新加载并保留本程序的修改")
+            self.load()
+            return
+        self.signature = signature
+        del self.pending[:count]
+        self.pending_since = time.monotonic() if self.pending else None
+
+    def request_compact(self):
+        """菜单脚本修改 urls.json 前的请求（SIGUSR1）：立即合并日志，之后暂停定期合并"""
+        self.hold_until = time.monotonic() + self.MENU_HOLD
+        self.compact_requested.set()
+
+    def allocate_id(self):
+        """分配新ID，删除条目后也不会和已有ID冲突"""
+        while str(self.next_id) in self.by_id:
+            self.next_id += 1
+        new_id = str(self.next_id)
+        self.next_id += 1
+        return new_id
+
+    def get(self, url):
+        id_str = self.by_url.get(url)
+        return self.by_id.get(id_str) if id_str is not None else None
+
+    def get_by_id(self, id_str):
+        return self.by_id.get(id_str)
+
+    def get_id(self, url):
+        return self.by_url.get(url)
+
+    def get_config(self, url):
+        """商品的配置说明，没有时返回空字符串"""
+        entry = self.get(url)
+        return entry.get('配置', '') if entry else ''
+
+    def get_anchor(self, url):
+        """商品在共用页面中的锚点文本（小写），没有时返回空字符串"""
+        entry = self.get(url)
+        return entry.get('锚点', '').lower() if entry else ''
+
+    def get_selector(self, url):
+        """商品在页面中的CSS选择器或XPath，没有时返回空字符串"""
+        entry = self.get(url)
+        return entry.get('选择器', '') if entry else ''
+
+    async def add(self, name, url, config=None):
+        """添加或更新条目，返回条目ID"""
+        id_str = self.by_url.get(url)
+        entry = dict(self.by_id[id_str]) if id_str is not None else {}
+        if id_str is None:
+            id_str = self.allocate_id()
+        entry.update({
+            "名称": name,
+            "URL": url,
+            "配置": config if config else ""
+        })
+        await self.commit({'op': 'put', 'id': id_str, 'entry': entry})
+        return id_str
+
+    def get_subscribers(self, url):
+        """订阅该商品的聊天ID列表"""
+        entry = self.get(url)
+        if entry is None:
+            return []
+        if '订阅' in entry:
+            return [str(chat_id) for chat_id in entry['订阅']]
+        return [self.default_chat] if self.default_chat else []
+
+    def is_subscribed(self, url, chat_id):
+        return str(chat_id) in self.get_subscribers(url)
+
+    async def subscribe(self, name, url, chat_id, config=None):
+        """为聊天订阅商品，返回 (条目ID, 是否新建条目)
+
+        已有其他聊天监控的URL只加入订阅，不重复监控；条目的名称和配置保持不变，由调用方告知用户
+        """
+        chat_id = str(chat_id)
+        id_str = self.by_url.get(url)
+        if id_str is None:
+            id_str = self.allocate_id()
+            entry = {
+                "名称": name,
+                "URL": url,
+                "配置": config if config else "",
+                "订阅": [chat_id]
+            }
+            await self.commit({'op': 'put', 'id': id_str, 'entry': entry})
+            return id_str, True
+        subscribers = self.get_subscribers(url)
+        if chat_id not in subscribers:
+            entry = dict(self.by_id[id_str])
+            entry['订阅'] = subscribers + [chat_id]
+            await self.commit({'op': 'put', 'id': id_str, 'entry': entry})
+        return id_str, False
+
+    async def unsubscribe(self, url, chat_id):
+        """取消聊天的订阅，返回是否已没有订阅者（此时由调用方删除条目）；未订阅时返回 None"""
+        chat_id = str(chat_id)
+        subscribers = self.get_subscribers(url)
+        if chat_id not in subscribers:
+            return None
+        remaining = [subscriber for subscriber in subscribers if subscriber != chat_id]
+        if not remaining:
+            return True
+        id_str = self.by_url[url]
+        entry = dict(self.by_id[id_str])
+        entry['订阅'] = remaining
+        await self.commit({'op': 'put', 'id': id_str, 'entry': entry})
+        return False
+
+    async def remove(self, url):
+        """删除条目，返回被删除的条目，不存在时返回 None"""
+        id_str = self.by_url.get(url)
+        if id_str is None:
+            return None
+        entry = self.by_id[id_str]
+        await self.commit({'op': 'del', 'id': id_str})
+        return entry
+
+    def snapshot(self):
+        """当前监控列表 {URL: 名称} 的副本，不访问磁盘"""
+        return {url: self.by_id[id_str].get('名称', '') for url, id_str in self.by_url.items()}
+
+    async def watch(self, interval, compact_interval):
+        """后台定期检查文件签名，菜单脚本修改 urls.json 后自动重新加载；定期合并日志"""
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.compact_requested.wait(), interval)
+            try:
+                if self.refresh():
+                    # 菜单脚本已写入 urls.json，恢复定期合并
+                    self.hold_until = 0
+                if self.compact_requested.is_set():
+                    self.compact_requested.clear()
+                    await self.compact()
+                    if self.pending:
+                        # 合并时遇到外部修改（已重新加载）或期间有新的修改，立即再合并一次
+                        self.compact_requested.set()
+                elif self.pending and time.monotonic() >= self.hold_until and (
+                    len(self.pending) >= self.COMPACT_ENTRIES
+                    or time.monotonic() - self.pending_since >= compact_interval
+                ):
+                    await self.compact()
+            except Exception as e:
+                self.logger.error(f"检查URL文件变化时出错: {str(e)}")
+
+    async def close(self):
+        """退出前合并日志"""
+        try:
+            await self.compact()
+        except Exception as e:
+            self.logger.error(f"合并URL日志失败: {str(e)}")
+        self.io.shutdown(wait=True)
+
+class HistoryRing:
+    """单个商品的检查历史：定长数组实现的环形缓冲区，内存占用固定"""
+
+    __slots__ = ('capacity', 'next', 'count', 'times', 'verdicts', 'statuses', 'latencies', 'sizes')
+
+    HEADER = struct.Struct('<III')
+    # 判定结果编码
+    IN_STOCK, OUT_OF_STOCK, ERROR = 1, 0, -1
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.next = 0
+        self.count = 0
+        self.times = array.array('d', bytes(8 * capacity))  # 检查时间戳
+        self.verdicts = array.array('b', bytes(capacity))  # 判定结果
+        self.statuses = array.array('H', bytes(2 * capacity))  # HTTP状态码，0 表示没有响应
+        self.latencies = array.array('f', bytes(4 * capacity))  # 下载耗时（秒）
+        self.sizes = array.array('I', bytes(4 * capacity))  # 下载字节数
+
+    def append(self, timestamp, verdict, status, latency, size):
+        i = self.next
+        self.times[i] = timestamp
+        self.verdicts[i] = verdict
+        self.statuses[i] = min(status, 0xFFFF)
+        self.latencies[i] = latency
+        self.sizes[i] = min(size, 0xFFFFFFFF)
+        self.next = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def entries(self):
+        """按时间从旧到新返回 (时间戳, 判定, 状态码, 耗时, 字节数)"""
+        start = (self.next - self.count) % self.capacity
+        for offset in range(self.count):
+            i = (start + offset) % self.capacity
+            yield self.times[i], self.verdicts[i], self.statuses[i], self.latencies[i], self.sizes[i]
+
+    def to_bytes(self):
+        return self.HEADER.pack(self.capacity, self.next, self.count) + b''.join(
+            column.tobytes() for column in (self.times, self.verdicts, self.statuses, self.latencies, self.sizes)
+        )
+
+    @classmethod
+    def from_bytes(cls, data, capacity):
+        """从快照恢复，容量与当前配置不同时按时间顺序重新写入"""
+        saved_capacity, next_index, count = cls.HEADER.unpack_from(data)
+        ring = cls(saved_capacity)
+        offset = cls.HEADER.size
+        for column in (ring.times, ring.verdicts, ring.statuses, ring.latencies, ring.sizes):
+            size = column.itemsize * saved_capacity
+            column[:] = array.array(column.typecode, data[offset:offset + size])
+            offset += size
+        ring.next, ring.count = next_index, count
+        if saved_capacity == capacity:
+            return ring
+        resized = cls(capacity)
+        for entry in ring.entries():
+            resized.append(*entry)
+        return resized
+
+class CheckHistory:
+    """所有商品的检查历史，/stats 和 /history 直接由环形缓冲区计算，不读取日志"""
+
+    def __init__(self, capacity=128):
+        self.capacity = max(1, capacity)
+        self.rings = {}  # URL -> HistoryRing
+
+    def record(self, url, stock_available, error, status=0, latency=0.0, size=0):
+        if error:
+            verdict = HistoryRing.ERROR
+        else:
+            verdict = HistoryRing.IN_STOCK if stock_available else HistoryRing.OUT_OF_STOCK
+        ring = self.rings.get(url)
+        if ring is None:
+            ring = self.rings[url] = HistoryRing(self.capacity)
+        ring.append(time.time(), verdict, status, latency, size)
+
+    def remove(self, url):
+        self.rings.pop(url, None)
+
+    def snapshot(self):
+        """[(URL, 快照数据)]，用于退出时保存"""
+        return [(url, ring.to_bytes()) for url, ring in self.rings.items()]
+
+    def restore(self, rows, urls):
+        for url, data in rows:
+            if url not in urls:
+                continue
+            try:
+                self.rings[url] = HistoryRing.from_bytes(data, self.capacity)
+            except (struct.error, ValueError):
+                continue
+
+    @staticmethod
+    def percentile(values, q):
+        return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+    def summarize(self, urls):
+        """汇总一组URL的历史：(检查次数, 成功率, p50 耗时, p95 耗时)，没有记录时返回 None"""
+        total = succeeded = 0
+        latencies = []
+        for url in urls:
+            ring = self.rings.get(url)
+            if ring is None:
+                continue
+            for _, verdict, status, latency, _ in ring.entries():
+                total += 1
+                if verdict != HistoryRing.ERROR:
+                    succeeded += 1
+                if status:
+                    latencies.append(latency)
+        if not total:
+            return None
+        latencies.sort()
+        return total, succeeded / total, self.percentile(latencies, 0.5), self.percentile(latencies, 0.95)
+
+    def transitions(self, url, limit=10):
+        """最近的补货（无货→有货）和售罄（有货→无货）记录 [(时间戳, 是否补货)]，从新到旧；检查失败不打断状态"""
+        ring = self.rings.get(url)
+        if ring is None:
+            return []
+        changes = []
+        previous = None
+        for timestamp, verdict, _, _, _ in ring.entries():
+            if verdict == HistoryRing.ERROR:
+                continue
+            if previous is not None and verdict != previous:
+                changes.append((timestamp, verdict == HistoryRing.IN_STOCK))
+            previous = verdict
+        return changes[::-1][:limit]
+
+class StateStore:
+    """库存状态持久化（SQLite WAL 模式），重启后从上次的状态继续"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS url_state ('
+            'url TEXT PRIMARY KEY, '
+            'stock_status INTEGER, '
+            'notification_count INTEGER NOT NULL DEFAULT 0, '
+            'last_check REAL, '
+            'last_verdict TEXT, '
+            'last_error TEXT)'
+        )
+        self.conn.execute('CREATE TABLE IF NOT EXISTS check_history (url TEXT PRIMARY KEY, data BLOB NOT NULL)')
+        self.conn.commit()
+
+    def load(self):
+        """读取所有URL的状态 {url: 行数据}"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT url, stock_status, notification_count, last_check, last_verdict, last_error FROM url_state'
+            ).fetchall()
+        states = {}
+        for url, stock_status, notification_count, last_check, last_verdict, last_error in rows:
+            states[url] = {
+                'stock_status': None if stock_status is None else bool(stock_status),
+                'notification_count': notification_count,
+                'last_check': last_check or 0,
+                'last_verdict': last_verdict,
+                'last_error': last_error
+            }
+        return states
+
+    def save_many(self, rows):
+        """批量写入 (url, stock_status, notification_count, last_check, last_verdict, last_error)"""
+        with self.lock:
+            self.conn.executemany(
+                'INSERT INTO url_state (url, stock_status, notification_count, last_check, last_verdict, last_error) '
+                'VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(url) DO UPDATE SET '
+                'stock_status = excluded.stock_status, '
+                'notification_count = excluded.notification_count, '
+                'last_check = excluded.last_check, '
+                'last_verdict = excluded.last_verdict, '
+                'last_error = excluded.last_error',
+                [
+                    (url, None if stock_status is None else int(stock_status), count, last_check, verdict, error)
+                    for url, stock_status, count, last_check, verdict, error in rows
+                ]
+            )
+            self.conn.commit()
+
+    def load_history(self):
+        """读取检查历史快照 [(url, 数据)]"""
+        with self.lock:
+            return self.conn.execute('SELECT url, data FROM check_history').fetchall()
+
+    def save_history(self, rows):
+        """用新的快照替换全部检查历史"""
+        with self.lock:
+            with self.conn:
+                self.conn.execute('DELETE FROM check_history')
+                self.conn.executemany('INSERT INTO check_history (url, data) VALUES (?, ?)', rows)
+
+    def delete(self, url):
+        with self.lock:
+            self.conn.execute('DELETE FROM url_state WHERE url = ?', (url,))
+            self.conn.execute('DELETE FROM check_history WHERE url = ?', (url,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class SQLiteLeaseStore:
+    """集群协调：放在共享存储上的 SQLite 文件，保存每个URL的检查租约和各节点共享的库存状态
+
+    共享存储（NFS 等）上不能使用 WAL，这里使用默认的回滚日志模式，每个操作一个短事务。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            'url TEXT PRIMARY KEY, '
+            'node TEXT NOT NULL, '
+            'expires REAL NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS shared_state ('
+            'url TEXT PRIMARY KEY, '
+            'stock_status INTEGER, '
+            'notification_count INTEGER NOT NULL DEFAULT 0, '
+            'node TEXT, '
+            'updated REAL)'
+        )
+
+    def claim_sync(self, leases, node):
+        """leases: {url: 租期（秒）}，返回 {url: (是否取得, 租约到期时间)}"""
+        now = time.time()
+        results = {}
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for url, ttl in leases.items():
+                    # 没有租约、租约已过期或本来就是本节点持有时取得租约
+                    self.conn.execute(
+                        'INSERT INTO leases (url, node, expires) VALUES (?, ?, ?) '
+                        'ON CONFLICT(url) DO UPDATE SET node = excluded.node, expires = excluded.expires '
+                        'WHERE leases.expires <= ? OR leases.node = excluded.node',
+                        (url, node, now + ttl, now)
+                    )
+                    holder, expires = self.conn.execute(
+                        'SELECT node, expires FROM leases WHERE url = ?', (url,)
+                    ).fetchone()
+                    results[url] = (holder == node, expires)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return results
+
+    def held_sync(self, urls, node):
+        """仍由本节点持有且未过期租约的URL"""
+        now = time.time()
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT url FROM leases WHERE node = ? AND expires > ? AND url IN ({','.join('?' * len(urls))})",
+                (node, now, *urls)
+            ).fetchall() if urls else []
+        return {url for url, in rows}
+
+    def load_states_sync(self, urls):
+        """共享的库存状态 {url: (stock_status, notification_count)}"""
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT url, stock_status, notification_count FROM shared_state WHERE url IN ({','.join('?' * len(urls))})",
+                tuple(urls)
+            ).fetchall() if urls else []
+        return {url: (None if status is None else bool(status), count) for url, status, count in rows}
+
+    def save_states_sync(self, states, node):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany(
+                    'INSERT INTO shared_state (url, stock_status, notification_count, node, updated) '
+                    'VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT(url) DO UPDATE SET '
+                    'stock_status = excluded.stock_status, '
+                    'notification_count = excluded.notification_count, '
+                    'node = excluded.node, '
+                    'updated = excluded.updated',
+                    [
+                        (url, None if status is None else int(status), count, node, now)
+                        for url, (status, count) in states.items()
+                    ]
+                )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    async def claim(self, leases, node):
+        return await asyncio.to_thread(self.claim_sync, leases, node)
+
+    async def held(self, urls, node):
+        return await asyncio.to_thread(self.held_sync, list(urls), node)
+
+    async def load_states(self, urls):
+        return await asyncio.to_thread(self.load_states_sync, list(urls))
+
+    async def save_states(self, states, node):
+        await asyncio.to_thread(self.save_states_sync, states, node)
+
+    async def close(self):
+        with self.lock:
+            self.conn.close()
+
+class RedisLeaseStore:
+    """集群协调：Redis 协议的服务器（或兼容的替代实现），只用到 GET / SET NX|XX PX / PTTL
+
+    租约是带过期时间的键，节点退出后租约到期自动失效，其它节点即可接手。
+    """
+
+    KEY_PREFIX = 'vpsmonitor'
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.strip('/') or 0)
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()  # 一个连接上的请求和响应按顺序配对
+
+    def key(self, kind, url):
+        return f"{self.KEY_PREFIX}:{kind}:{hashlib.sha1(url.encode('utf-8')).hexdigest()}"
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis 连接已关闭")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise RuntimeError(f"Redis 错误: {payload.decode()}")
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2].decode('utf-8')
+        if kind == b'*':
+            count = int(payload)
+            return None if count == -1 else [await self.read_reply() for _ in range(count)]
+        raise RuntimeError(f"无法解析的 Redis 响应: {line!r}")
+
+    async def command(self, *args):
+        async with self.lock:
+            try:
+                if self.writer is None:
+                    self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                    if self.password:
+                        await self.send('AUTH', self.password)
+                    if self.db:
+                        await self.send('SELECT', self.db)
+                return await self.send(*args)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                # 下次请求时重新连接
+                if self.writer is not None:
+                    self.writer.close()
+                self.reader = self.writer = None
+                raise
+
+    async def send(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self.writer.write(b''.join(parts))
+        await self.writer.drain()
+        return await self.read_reply()
+
+    async def claim(self, leases, node):
+        now = time.time()
+        results = {}
+        for url, ttl in leases.items():
+            key = self.key('lease', url)
+            milliseconds = max(1, int(ttl * 1000))
+            if await self.command('SET', key, node, 'NX', 'PX', milliseconds) is not None:
+                results[url] = (True, now + ttl)
+                continue
+            # 已被占用：本节点持有时沿用原租约，不续期，避免覆盖刚被其它节点接手的租约
+            holder = await self.command('GET', key)
+            remaining = await self.command('PTTL', key)
+            results[url] = (holder == node, now + max(remaining, 0) / 1000)
+        return results
+
+    async def held(self, urls, node):
+        return {url for url in urls if await self.command('GET', self.key('lease', url)) == node}
+
+    async def load_states(self, urls):
+        states = {}
+        for url in urls:
+            value = await self.command('GET', self.key('state', url))
+            if value is not None:
+                state = json.loads(value)
+                states[url] = (state['stock_status'], state['notification_count'])
+        return states
+
+    async def save_states(self, states, node):
+        for url, (status, count) in states.items():
+            await self.command('SET', self.key('state', url), json.dumps({
+                'stock_status': status,
+                'notification_count': count,
+                'node': node,
+                'updated': time.time()
+            }))
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+def open_lease_store(spec):
+    """按配置创建集群协调存储：redis:// 开头为 Redis 协议服务器，否则为 SQLite 文件路径"""
+    if spec.startswith('redis://'):
+        return RedisLeaseStore(spec)
+    return SQLiteLeaseStore(spec)
+
+class NotificationQueue:
+    """Telegram 发送队列：独立任务发送，遵守全局和单个聊天的频率限制，同一轮的事件合并成摘要"""
+
+    MAX_MESSAGE_LENGTH = 4096
+    DIGEST_SEPARATOR = "\n\n━━━━━━━━━━\n\n"
+
+    def __init__(self, logger, global_rate=25, chat_interval=1.0, group_per_minute=20, max_retries=5, metrics=None):
+        self.logger = logger
+        self.bot = None
+        self.queue = asyncio.Queue()
+        self.digests = {}  # chat_id -> 本轮待合并的消息
+        self.global_rate = global_rate  # 全局每秒最多发送数
+        self.chat_interval = chat_interval  # 同一聊天两条消息的最小间隔（秒）
+        self.group_per_minute = group_per_minute  # 群组每分钟最多发送数
+        self.max_retries = max_retries
+        self.global_sent = deque()  # 最近一秒的发送时间
+        self.chat_sent = {}  # chat_id -> 最近一分钟的发送时间
+        # 每个聊天一个发送任务，按顺序发送；某个聊天被限流时不影响其他聊天
+        self.chat_queues = {}  # chat_id -> 待发送的消息
+        self.chat_tasks = set()
+        self.sent_count = 0
+        self.failed_count = 0
+        self.metrics = metrics  # 可选，记录发送耗时
+
+    def send(self, chat_id, text):
+        """立即排队发送一条消息"""
+        for part in self.split(text):
+            self.queue.put_nowait((chat_id, part))
+
+    def add_to_digest(self, chat_id, text):
+        """加入本轮摘要，等 flush_digests() 时合并发送"""
+        self.digests.setdefault(chat_id, []).append(text)
+
+    def flush_digests(self):
+        """把本轮摘要合并成尽量少的消息（每条不超过4096字符）后排队"""
+        digests, self.digests = self.digests, {}
+        for chat_id, texts in digests.items():
+            current = ''
+            for text in texts:
+                for part in self.split(text):
+                    if current and len(current) + len(self.DIGEST_SEPARATOR) + len(part) > self.MAX_MESSAGE_LENGTH:
+                        self.queue.put_nowait((chat_id, current))
+                        current = ''
+                    current = current + self.DIGEST_SEPARATOR + part if current else part
+            if current:
+                self.queue.put_nowait((chat_id, current))
+
+    def split(self, text):
+        """超长消息按行拆分"""
+        if len(text) <= self.MAX_MESSAGE_LENGTH:
+            return [text]
+        parts = []
+        current = ''
+        for line in text.split('\n'):
+            while len(line) > self.MAX_MESSAGE_LENGTH:
+                if current:
+                    parts.append(current)
+                    current = ''
+                parts.append(line[:self.MAX_MESSAGE_LENGTH])
+                line = line[self.MAX_MESSAGE_LENGTH:]
+            if current and len(current) + 1 + len(line) > self.MAX_MESSAGE_LENGTH:
+                parts.append(current)
+                current = line
+            else:
+                current = current + '\n' + line if current else line
+        if current:
+            parts.append(current)
+        return parts
+
+    async def wait_rate_limit(self, chat_id):
+        """等待直到全局和该聊天的频率限制都允许发送"""
+        is_group = str(chat_id).startswith('-')
+        while True:
+            now = time.monotonic()
+            while self.global_sent and now - self.global_sent[0] >= 1:
+                self.global_sent.popleft()
+            sent = self.chat_sent.setdefault(chat_id, deque())
+            while sent and now - sent[0] >= 60:
+                sent.popleft()
+
+            wait = 0.0
+            if len(self.global_sent) >= self.global_rate:
+                wait = max(wait, 1 - (now - self.global_sent[0]))
+            if sent:
+                wait = max(wait, self.chat_interval - (now - sent[-1]))
+            if is_group and len(sent) >= self.group_per_minute:
+                wait = max(wait, 60 - (now - sent[0]))
+            if wait <= 0:
+                self.global_sent.append(now)
+                sent.append(now)
+                return
+            await asyncio.sleep(wait)
+
+    async def deliver(self, chat_id, text):
+        """发送一条消息，被限流时按 RetryAfter 等待后重试"""
+        error = None
+        for attempt in range(self.max_retries):
+            await self.wait_rate_limit(chat_id)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                self.sent_count += 1
+                self.logger.info("Telegram 通知发送成功")
+                return True
+            except RetryAfter as e:
+                error = e
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+                self.logger.warning(f"Telegram 限流，{retry_after} 秒后重试")
+                await asyncio.sleep(retry_after)
+            except (TimedOut, NetworkError) as e:
+                error = e
+                delay = min(30, 2 ** attempt)
+                self.logger.warning(f"发送Telegram通知失败: {str(e)}，{delay} 秒后重试")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                # 其它错误（如聊天不存在、机器人被移出群组）重试也不会成功
+                error = e
+                break
+        self.failed_count += 1
+        self.logger.error(f"发送Telegram通知到 {chat_id} 失败，已放弃: {type(error).__name__}: {error}；消息: {text[:50]}")
+        return False
+
+    def pending(self):
+        """尚未发送的消息数"""
+        return self.queue.qsize() + sum(len(texts) for texts in self.chat_queues.values())
+
+    async def run(self, bot):
+        """发送任务主循环：把消息分派给各聊天的发送任务"""
+        self.bot = bot
+        try:
+            while True:
+                chat_id, text = await self.queue.get()
+                texts = self.chat_queues.get(chat_id)
+                if texts is None:
+                    texts = self.chat_queues[chat_id] = deque()
+                    task = asyncio.create_task(self.run_chat(chat_id, texts))
+                    self.chat_tasks.add(task)
+                    task.add_done_callback(self.chat_tasks.discard)
+                texts.append(text)
+        finally:
+            for task in list(self.chat_tasks):
+                task.cancel()
+
+    async def run_chat(self, chat_id, texts):
+        """按顺序发送一个聊天的消息，发完后退出"""
+        try:
+            while texts:
+                text = texts.popleft()
+                started = time.monotonic()
+                try:
+                    await self.deliver(chat_id, text)
+                    if self.metrics is not None:
+                        self.metrics.observe('vpsmonitor_notification_seconds', time.monotonic() - started)
+                except Exception as e:
+                    self.logger.error(f"发送Telegram通知失败: {str(e)}")
+                finally:
+                    self.queue.task_done()
+        finally:
+            self.chat_queues.pop(chat_id, None)
+
+    async def drain(self, timeout):
+        """退出前尽量发完队列中的消息"""
+        self.flush_digests()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"退出时仍有 {self.pending()} 条通知未发送")
+
+class PollScheduler:
+    """按URL安排下次检查时间（最小堆），根据检查结果自适应调整每个URL的检查间隔"""
+
+    INTERVAL_KEYS = ('检查间隔', '最小间隔', '最大间隔')
+    STABLE_STREAK = 5  # 连续多少次页面无变化后才开始放慢
+    STABLE_FACTOR = 1.1  # 之后每次无变化间隔放大的倍数
+
+    def __init__(self, base_interval, min_interval, max_interval, adaptive=True, logger=None):
+        self.logger = logger
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.adaptive = adaptive
+        self.heap = []  # (到期时间, 序号, URL)，失效条目在弹出时跳过
+        self.due = {}  # URL -> 当前有效的到期时间
+        self.intervals = {}  # URL -> 当前检查间隔
+        self.overrides = {}  # URL -> 条目中的间隔设置
+        self.stable_streaks = {}  # URL -> 连续无变化的检查次数
+        self.invalid = set()  # 已记录过的无效间隔设置 (URL, 键, 值)
+        self.counter = 0
+
+    def bounds(self, url):
+        """URL的 (基础间隔, 最小间隔, 最大间隔)，条目中设置了 "检查间隔" 时固定为该值"""
+        override = self.overrides.get(url, {})
+        fixed = override.get('检查间隔')
+        if fixed:
+            return fixed, fixed, fixed
+        min_interval = override.get('最小间隔', self.min_interval)
+        max_interval = override.get('最大间隔', self.max_interval)
+        base = min(max(self.base_interval, min_interval), max_interval)
+        return base, min_interval, max_interval
+
+    def schedule(self, url, due):
+        self.counter += 1
+        self.due[url] = due
+        heapq.heappush(self.heap, (due, self.counter, url))
+
+    def sync(self, entries, last_check):
+        """与监控列表同步：新URL按上次检查时间排期，已删除的URL移出调度"""
+        for url in list(self.due):
+            if url not in entries:
+                self.remove(url)
+        for url, entry in entries.items():
+            self.overrides[url] = self.parse_overrides(url, entry)
+            base, min_interval, max_interval = self.bounds(url)
+            interval = min(max(self.intervals.get(url, base), min_interval), max_interval)
+            self.intervals[url] = interval
+            if url not in self.due:
+                self.schedule(url, last_check.get(url, 0) + interval)
+
+    def parse_overrides(self, url, entry):
+        """读取条目中的间隔设置，不是正数的值忽略（使用全局设置）并记录一次警告"""
+        overrides = {}
+        for key in self.INTERVAL_KEYS:
+            value = entry.get(key)
+            if not value:
+                continue
+            try:
+                interval = float(value)
+                if not interval > 0 or interval == float('inf'):
+                    raise ValueError
+            except (TypeError, ValueError):
+                marker = (url, key, repr(value))
+                if self.logger and marker not in self.invalid:
+                    self.invalid.add(marker)
+                    self.logger.warning(f"{url} 的 {key} 设置无效（{value!r}），使用全局设置")
+                continue
+            overrides[key] = interval
+        return overrides
+
+    def remove(self, url):
+        self.due.pop(url, None)
+        self.intervals.pop(url, None)
+        self.overrides.pop(url, None)
+        self.stable_streaks.pop(url, None)
+
+    def pop_due(self, now):
+        """弹出所有已到期的URL"""
+        due_urls = []
+        while self.heap and self.heap[0][0] <= now:
+            due, _, url = heapq.heappop(self.heap)
+            if self.due.get(url) == due:
+                del self.due[url]
+                due_urls.append(url)
+        return due_urls
+
+    def take(self, url):
+        """提前取出尚未到期的URL（与到期的URL共用页面时一起检查），不在调度中时返回 False"""
+        if url not in self.due:
+            return False
+        del self.due[url]
+        return True
+
+    def next_due(self):
+        """最近的到期时间，没有任务时返回 None"""
+        while self.heap and self.due.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def update(self, url, outcome, now):
+        """根据检查结果调整间隔并安排下次检查
+
+        outcome: flip 状态变化、volatile 页面内容有变化、stable 无变化、error 检查失败
+        """
+        if url not in self.intervals:
+            return
+        base, min_interval, max_interval = self.bounds(url)
+        interval = self.intervals[url]
+        streak = self.stable_streaks.get(url, 0) + 1 if outcome == 'stable' else 0
+        self.stable_streaks[url] = streak
+        if self.adaptive:
+            if outcome == 'flip':
+                # 刚补货或刚售罄，短时间内可能再次变化
+                interval = min_interval
+            elif outcome == 'volatile':
+                interval *= 0.75
+            elif outcome == 'stable' and streak >= self.STABLE_STREAK:
+                # 只比上次检查没有变化不代表页面长期稳定，连续多次无变化后才缓慢放慢
+                interval *= self.STABLE_FACTOR
+            elif outcome == 'error':
+                interval *= 2
+        else:
+            interval = base
+        interval = min(max(interval, min_interval), max_interval)
+        self.intervals[url] = interval
+        self.schedule(url, now + interval)
+
+class ClearanceCache:
+    """按主机缓存 Cloudflare 通行凭证（cf_clearance 及会话 cookies）和签发时使用的 User-Agent"""
+
+    CLEARANCE_COOKIE = 'cf_clearance'
+    DEFAULT_LIFETIME = 30 * 60  # cookie 未标明过期时间时的有效期（秒）
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.entries = {}  # 主机 -> {'cookies': {...}, 'user_agent': ..., 'expires': 时间戳}
+        self.lock = threading.Lock()  # 在多个请求线程中读写
+        self.dirty = False
+        self.stats = {'solved': 0, 'reused': 0, 'expired': 0}
+
+    def load(self):
+        """从文件加载未过期的凭证"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.error(f"加载Cloudflare凭证失败: {str(e)}")
+            return
+        now = time.time()
+        with self.lock:
+            self.entries = {host: entry for host, entry in entries.items() if entry.get('expires', 0) > now}
+        if self.entries:
+            self.logger.info(f"已加载 {len(self.entries)} 个主机的Cloudflare凭证")
+
+    def save(self):
+        """有变化时写入文件（先写临时文件再替换）"""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.entries, ensure_ascii=False, indent=4)
+            self.dirty = False
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def has(self, host):
+        """主机是否有未过期的凭证"""
+        with self.lock:
+            entry = self.entries.get(host)
+            return entry is not None and entry['expires'] > time.time()
+
+    def get(self, host):
+        """取出主机的有效凭证，过期的凭证会被丢弃"""
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is None:
+                return None
+            if entry['expires'] <= time.time():
+                del self.entries[host]
+                self.dirty = True
+                self.stats['expired'] += 1
+                return None
+            return {'cookies': dict(entry['cookies']), 'user_agent': entry['user_agent']}
+
+    def update(self, host, cookie_jar, user_agent, sent, passed):
+        """请求完成后更新凭证：出现新的 cf_clearance 记为解决了一次挑战，沿用旧凭证通过记为复用"""
+        hostname = host.split(':')[0]
+        cookies = {}
+        expires = None
+        try:
+            # 会话 cookies 可能正被其他请求线程修改，先复制一份
+            jar_cookies = list(cookie_jar)
+        except RuntimeError:
+            return
+        for cookie in jar_cookies:
+            domain = cookie.domain.lstrip('.')
+            if hostname != domain and not hostname.endswith('.' + domain):
+                continue
+            cookies[cookie.name] = cookie.value
+            if cookie.name == self.CLEARANCE_COOKIE and cookie.expires:
+                expires = cookie.expires
+
+        clearance = cookies.get(self.CLEARANCE_COOKIE)
+        with self.lock:
+            sent_clearance = sent['cookies'].get(self.CLEARANCE_COOKIE) if sent else None
+            if clearance and clearance != sent_clearance:
+                self.stats['solved'] += 1
+                self.entries[host] = {
+                    'cookies': cookies,
+                    'user_agent': user_agent,
+                    'expires': expires or time.time() + self.DEFAULT_LIFETIME
+                }
+                self.dirty = True
+            elif sent_clearance and passed:
+                self.stats['reused'] += 1
+            elif sent_clearance and not passed:
+                # 凭证已失效，下次重新解决挑战
+                self.entries.pop(host, None)
+                self.dirty = True
+
+    def summary(self):
+        stats = self.stats
+        return f"解决挑战 {stats['solved']} 次，复用凭证 {stats['reused']} 次，过期 {stats['expired']} 次"
+
+class Metrics:
+    """进程内运行指标，按 OpenMetrics 文本格式输出"""
+
+    CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    CYCLE_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800)
+    # 指标名 -> (类型, 说明, 直方图分桶)
+    FAMILIES = {
+        'vpsmonitor_check_stage_seconds': ('histogram', '单次页面检查各阶段耗时：queue_wait 排队、fetch 网络、decode 解码、classify 判定', LATENCY_BUCKETS),
+        'vpsmonitor_notification_seconds': ('histogram', '发送一条Telegram通知的耗时（含限流等待和重试）', LATENCY_BUCKETS),
+        'vpsmonitor_cycle_seconds': ('histogram', '一批检查的总耗时', CYCLE_BUCKETS),
+        'vpsmonitor_checks': ('counter', '按结果统计的商品检查次数', None),
+        'vpsmonitor_downloaded_bytes': ('counter', '按主机统计的页面下载字节数', None),
+        'vpsmonitor_in_flight_checks': ('gauge', '按主机统计的正在下载的页面数', None),
+        'vpsmonitor_notification_queue': ('gauge', '等待发送的Telegram通知数', None),
+        'vpsmonitor_monitored_urls': ('gauge', '监控中的URL数', None),
+        'vpsmonitor_worker_processes': ('gauge', '存活的工作进程数（多进程模式）', None),
+        'vpsmonitor_loop_lag_seconds': ('histogram', '事件循环延迟（定时唤醒的实际延迟）', LATENCY_BUCKETS),
+        'vpsmonitor_loop_stalls': ('counter', '事件循环被单个回调阻塞超过阈值的次数', None),
+        'vpsmonitor_open_circuits': ('gauge', '熔断中（暂停检查）的主机数', None),
+        'vpsmonitor_probe_checks': ('counter', '平台探测次数，result=definitive 直接得出结论，fallback 改用关键词判断', None),
+    }
+
+    def __init__(self):
+        self.samples = {name: {} for name in self.FAMILIES}  # 指标名 -> {标签: 值}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        samples = self.samples[name]
+        samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.samples[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        """记录一次直方图观测值，按桶保存非累计计数，输出时再累加"""
+        buckets = self.FAMILIES[name][2]
+        key = tuple(sorted(labels.items()))
+        series = self.samples[name].get(key)
+        if series is None:
+            series = self.samples[name][key] = {'buckets': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0}
+        index = 0
+        while index < len(buckets) and value > buckets[index]:
+            index += 1
+        series['buckets'][index] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    def merge(self, samples):
+        """累加另一个进程的指标快照"""
+        for name, series in samples.items():
+            target = self.samples[name]
+            for key, value in series.items():
+                if not isinstance(value, dict):
+                    target[key] = target.get(key, 0) + value
+                    continue
+                current = target.setdefault(key, {'buckets': [0] * len(value['buckets']), 'sum': 0.0, 'count': 0})
+                current['buckets'] = [a + b for a, b in zip(current['buckets'], value['buckets'])]
+                current['sum'] += value['sum']
+                current['count'] += value['count']
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for key, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        """生成 OpenMetrics 文本"""
+        lines = []
+        for name, (kind, help_text, buckets) in self.FAMILIES.items():
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"# HELP {name} {help_text}")
+            for labels, value in sorted(self.samples[name].items()):
+                if kind == 'counter':
+                    lines.append(f"{name}_total{self.format_labels(labels)} {value}")
+                elif kind == 'gauge':
+                    lines.append(f"{name}{self.format_labels(labels)} {value}")
+                else:
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], value['buckets']):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_count{self.format_labels(labels)} {value['count']}")
+                    lines.append(f"{name}_sum{self.format_labels(labels)} {value['sum']}")
+        lines.append("# EOF")
+        return '\n'.join(lines) + '\n'
+
+class LoopWatchdog:
+    """事件循环监视：定时唤醒测量延迟，保留最近的延迟分布；
+    后台线程发现循环超过阈值没有响应时，抓取正在阻塞循环的调用栈"""
+
+    INTERVAL = 0.1  # 采样间隔（秒）
+    WINDOW = 600  # 延迟分布保留的时长（秒）
+    SUMMARY_INTERVAL = 600  # 写入日志摘要的间隔（秒）
+    TOP_OFFENDERS = 5
+
+    def __init__(self, logger, threshold=0.5, metrics=None):
+        self.logger = logger
+        self.threshold = threshold
+        self.metrics = metrics
+        self.lags = deque(maxlen=int(self.WINDOW / self.INTERVAL))
+        self.offenders = {}  # 阻塞位置 -> {'count', 'total', 'worst', 'stack'}
+        self.stalls = 0
+        self.heartbeat = time.monotonic()
+        self.captured = None  # 后台线程抓取的 (心跳时间, 阻塞位置, 调用栈)
+        self.loop_thread = None
+        self.stopping = threading.Event()
+        self.task = None
+        self.thread = None
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopping.clear()
+        self.task = asyncio.create_task(self.run())
+        self.thread = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+        self.thread.start()
+
+    async def stop(self):
+        self.stopping.set()
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def run(self):
+        """定时唤醒，实际唤醒时间与预期之差即为事件循环延迟"""
+        last_summary = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.INTERVAL
+            await asyncio.sleep(self.INTERVAL)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.heartbeat = now
+            self.lags.append(lag)
+            if self.metrics:
+                self.metrics.observe('vpsmonitor_loop_lag_seconds', lag)
+            captured, self.captured = self.captured, None
+            if captured and lag >= self.threshold:
+                self.record_stall(lag, captured[1], captured[2])
+            if now - last_summary >= self.SUMMARY_INTERVAL:
+                last_summary = now
+                self.logger.info(f"事件循环延迟：{self.format_percentiles()}，阻塞 {self.stalls} 次")
+
+    def watch(self):
+        """后台线程：心跳超过阈值未更新时抓取事件循环线程当前的调用栈，每次阻塞只抓取一次"""
+        captured_beat = None
+        while not self.stopping.wait(self.INTERVAL):
+            beat = self.heartbeat
+            if beat == captured_beat or time.monotonic() - beat - self.INTERVAL < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            # 只保留事件循环调度的回调本身的调用栈
+            callback_start = max(
+                (i + 1 for i, entry in enumerate(stack) if entry.name == '_run' and entry.filename.endswith('events.py')),
+                default=0
+            )
+            stack = stack[callback_start:] or stack
+            captured_beat = beat
+            self.captured = (beat, self.locate(stack), ''.join(traceback.format_list(stack[-8:])))
+
+    @staticmethod
+    def locate(stack):
+        """阻塞位置：本程序中最内层的调用，加上实际阻塞的最内层调用"""
+        innermost = stack[-1]
+        own = next((frame for frame in reversed(stack) if frame.filename == __file__), None)
+        location = f"{os.path.basename(innermost.filename)}:{innermost.lineno} {innermost.name}"
+        if own is not None and own is not innermost:
+            location = f"{os.path.basename(own.filename)}:{own.lineno} {own.name} → {location}"
+        return location
+
+    def record_stall(self, duration, location, stack):
+        self.stalls += 1
+        if self.metrics:
+            self.metrics.inc('vpsmonitor_loop_stalls')
+        offender = self.offenders.setdefault(location, {'count': 0, 'total': 0.0, 'worst': 0.0, 'stack': ''})
+        offender['count'] += 1
+        offender['total'] += duration
+        if duration >= offender['worst']:
+            offender['worst'] = duration
+            offender['stack'] = stack
+        self.logger.warning(f"事件循环被阻塞 {duration:.2f} 秒：{location}\n{stack}")
+
+    def percentiles(self):
+        """最近一段时间的延迟 (p50, p95, p99, 最大值)，单位秒"""
+        if not self.lags:
+            return 0.0, 0.0, 0.0, 0.0
+        lags = sorted(self.lags)
+        pick = lambda q: lags[min(len(lags) - 1, int(len(lags) * q))]
+        return pick(0.5), pick(0.95), pick(0.99), lags[-1]
+
+    def format_percentiles(self):
+        p50, p95, p99, worst = self.percentiles()
+        return f"p50 {p50 * 1000:.0f}ms / p95 {p95 * 1000:.0f}ms / p99 {p99 * 1000:.0f}ms / 最大 {worst * 1000:.0f}ms"
+
+    def worst_offenders(self):
+        """按最长阻塞时间排序的阻塞位置"""
+        ranked = sorted(self.offenders.items(), key=lambda item: item[1]['worst'], reverse=True)
+        return ranked[:self.TOP_OFFENDERS]
+
+class WorkerLost(Exception):
+    """处理请求的工作进程已退出"""
+
+class WorkerPool:
+    """多进程检查：按主机哈希把URL分给各工作进程，请求和结果通过管道逐条传递
+
+    同一主机只由一个工作进程请求，主机限流和 Cloudflare 凭证在进程内仍然有效；
+    工作进程退出时，它负责的主机按最高随机权重哈希重新分给其余进程，并在稍后重启该进程。
+    """
+
+    RESTART_DELAY = 5  # 工作进程退出后重新启动的等待时间（秒）
+
+    def __init__(self, size, logger, max_pending=50):
+        self.size = size
+        self.logger = logger
+        self.max_pending = max_pending  # 每个工作进程未完成的请求上限，避免管道写满阻塞事件循环
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = {}  # 序号 -> {'process', 'conn', 'pending', 'slots', 'ready'}
+        self.metrics = {}  # 序号 -> 工作进程最近上报的指标快照
+        self.next_request = 0
+        self.closing = False
+        # 工作进程的日志经此队列交给主进程写入，避免多个进程同时写日志文件和轮转
+        self.log_queue = self.context.Queue()
+        self.log_listener = logging.handlers.QueueListener(self.log_queue, LogForwarder())
+        self.log_listener.start()
+
+    async def start(self, timeout=60):
+        """启动所有工作进程并等待它们就绪"""
+        for index in range(self.size):
+            self.spawn(index)
+        deadline = time.monotonic() + timeout
+        while not all(worker['ready'].is_set() for worker in self.workers.values()):
+            if time.monotonic() > deadline:
+                raise RuntimeError("工作进程启动超时")
+            await asyncio.sleep(0.1)
+        if not self.workers:
+            raise RuntimeError("工作进程启动失败")
+        self.logger.info(f"已启动 {len(self.workers)} 个工作进程")
+
+    def spawn(self, index):
+        if self.closing:
+            return
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=run_shard_worker, args=(index, child_conn, self.log_queue), name=f'shard-{index}', daemon=True
+        )
+        process.start()
+        child_conn.close()
+        self.workers[index] = {
+            'process': process,
+            'conn': parent_conn,
+            'pending': {},  # 请求ID -> Future
+            'slots': asyncio.Semaphore(self.max_pending),
+            'ready': asyncio.Event()
+        }
+        asyncio.get_running_loop().add_reader(parent_conn.fileno(), self.on_readable, index)
+
+    def live_workers(self):
+        return [index for index, worker in self.workers.items() if worker['ready'].is_set()]
+
+    def owner(self, url):
+        """负责该URL所属主机的工作进程（最高随机权重哈希，进程增减时只移动受影响的主机）"""
+        host = urllib.parse.urlparse(url).netloc.lower()
+        live = self.live_workers()
+        if not live:
+            return None
+        return max(live, key=lambda index: hashlib.sha1(f"{index}:{host}".encode('utf-8')).digest())
+
+    async def check(self, fetch_url, urls):
+        """交给负责的工作进程检查页面，返回 (结果, 页面内容是否有变化, 下载记录)；进程中途退出时改由其它进程重试"""
+        for _ in range(self.size + 1):
+            index = self.owner(fetch_url)
+            if index is None:
+                break
+            worker = self.workers[index]
+            async with worker['slots']:
+                if self.workers.get(index) is not worker:
+                    continue
+                self.next_request += 1
+                request_id = self.next_request
+                future = asyncio.get_running_loop().create_future()
+                worker['pending'][request_id] = future
+                try:
+                    worker['conn'].send(('check', request_id, fetch_url, urls))
+                    return await future
+                except WorkerLost:
+                    continue
+                except asyncio.CancelledError:
+                    # 本轮超时取消时通知工作进程放弃该请求
+                    if self.workers.get(index) is worker:
+                        with contextlib.suppress(OSError, ValueError):
+                            worker['conn'].send(('cancel', request_id))
+                    raise
+                except (OSError, ValueError):
+                    continue
+                finally:
+                    worker['pending'].pop(request_id, None)
+        return {url: (None, "没有可用的工作进程，将在下次检查时重试") for url in urls}, False, None
+
+    def on_readable(self, index):
+        worker = self.workers.get(index)
+        if worker is None:
+            return
+        try:
+            message = worker['conn'].recv()
+        except (EOFError, OSError):
+            self.on_worker_exit(index)
+            return
+        kind = message[0]
+        if kind == 'result':
+            _, request_id, results, changed, record = message
+            future = worker['pending'].get(request_id)
+            if future is not None and not future.done():
+                future.set_result((results, changed, record))
+        elif kind == 'metrics':
+            self.metrics[index] = message[1]
+        elif kind == 'ready':
+            worker['ready'].set()
+
+    def on_worker_exit(self, index):
+        """工作进程退出：未完成的请求转给其它进程，稍后重启该进程"""
+        worker = self.workers.pop(index)
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(worker['conn'].fileno())
+        worker['conn'].close()
+        for future in worker['pending'].values():
+            if not future.done():
+                future.set_exception(WorkerLost())
+        if self.closing:
+            return
+        self.logger.error(
+            f"工作进程 {index} 已退出，"
+            f"其负责的主机已分给其余 {len(self.live_workers())} 个进程，{self.RESTART_DELAY} 秒后重启"
+        )
+        loop.call_later(self.RESTART_DELAY, self.spawn, index)
+
+    async def close(self, timeout=10):
+        """通知工作进程退出，超时未退出的强制结束"""
+        self.closing = True
+        loop = asyncio.get_running_loop()
+        for worker in self.workers.values():
+            loop.remove_reader(worker['conn'].fileno())
+            with contextlib.suppress(OSError, ValueError):
+                worker['conn'].send(('stop',))
+        deadline = time.monotonic() + timeout
+        for worker in self.workers.values():
+            await loop.run_in_executor(None, worker['process'].join, max(0, deadline - time.monotonic()))
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+            worker['conn'].close()
+        self.workers = {}
+        await loop.run_in_executor(None, self.log_listener.stop)
+
 class VPSMonitor:
+    HISTORY_SAVE_INTERVAL = 300  # 定期保存检查历史快照的间隔（秒）
+
     def __init__(self):
+        self.logger = logging.getLogger(__name__)
         self.urls_file = 'urls.json'  # 改用json文件
         self.config_file = 'config.json'
         self.load_config()
+        # 添加状态追踪字典
+        self.stock_status = {}  # 存储每个URL的库存状态
+        self.notification_count = {}  # 存储每个URL的有货通知次数
+        self.first_run = True  # 标记是否是首次运行
+        # urls.json 的内存索引，文件变化时才重新加载
+        self.registry = URLRegistry(self.urls_file, self.logger, default_chat=self.chat_id)
+        self.registry.load()
+        self.registry_task = None
+        # 持久化的库存状态，重启后从上次的状态继续，避免全量检查和通知轰炸
+        self.state_store = StateStore(self.state_file)
+        self.last_check = {}  # 存储每个URL最近一次检查的时间戳
+        self.dirty_state = {}  # 本轮变化、尚未写入数据库的状态
+        self.verdicts = {}  # 每个URL最近一次的判定：in_stock / out_of_stock / error
+        self.status_version = 0  # 任一URL的判定变化时加一，用于刷新 /list 缓存
+        self.list_cache = {}  # (聊天, 筛选, 页码) -> (版本, 文本, 按钮)
+        self.list_index_cache = {}  # 聊天 -> (监控列表版本, 商品列表, 主机列表)
+        self.warm_start = False
+        # 每个商品最近的检查记录（定长环形缓冲区），定期和退出时保存
+        self.history = CheckHistory(self.history_size)
+        self.history_saved_at = time.monotonic()
+        self.restore_state()
+        # 运行指标，配置了 metrics_port 时通过 /metrics 提供
+        self.metrics = Metrics()
+        self.metrics_runner = None
+        # 事件循环延迟监视，记录阻塞循环的调用，/status 查看
+        self.watchdog = LoopWatchdog(self.logger, self.loop_lag_threshold, self.metrics)
+        self.started_at = time.time()
+        # Telegram 发送队列，检查流程不等待发送
+        self.notifier = NotificationQueue(self.logger, metrics=self.metrics)
+        self.notifier_task = None
+        # 按URL自适应检查间隔的调度器
+        self.scheduler = PollScheduler(
+            self.check_interval, self.min_interval, self.max_interval, self.adaptive_interval, self.logger
+        )
+        self.in_flight = set()  # 正在检查的URL
+        # 按主机熔断，无法访问的主机暂停检查，恢复前只通知一次
+        self.breaker = HostCircuitBreaker(self.breaker_threshold, self.breaker_backoff, self.breaker_max_backoff)
+        self.dispatch_event = asyncio.Event()  # 一批检查完成后唤醒调度循环
+        self.batch_tasks = set()
+        # 创建Telegram应用
+        self.app = None
+        self.setup_fetching()
+        # 多进程模式下由工作进程下载和判断页面，本进程只负责 Telegram、调度和状态
+        self.worker_pool = WorkerPool(self.worker_processes, self.logger) if self.worker_processes else None
+        # 集群模式下每个URL每个检查周期只由取得租约的节点检查，库存状态在节点间共享
+        self.cluster = open_lease_store(self.cluster_store) if self.cluster_store else None
+
+    def setup_fetching(self):
+        """创建下载和判断页面所需的对象（工作进程中也会调用）"""
         # 使用 Cloudscraper 初始化，添加更多浏览器参数
         self.scraper = cloudscraper.create_scraper(
             browser={
@@ -35,21 +2379,52 @@ class VPSMonitor:
                 'platform': 'windows',
                 'mobile': False,
                 'custom': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-            },
-            debug=True
+            }
         )
-        # 添加状态追踪字典
-        self.stock_status = {}  # 存储每个URL的库存状态
-        self.notification_count = {}  # 存储每个URL的有货通知次数
-        self.first_run = True  # 标记是否是首次运行
-        self.product_names = {}  # 存储URL对应的产品名称
-        self.product_configs = {}  # 存储URL对应的配置信息
-        # 创建Telegram应用
-        self.app = None
-        self.logger = logging.getLogger(__name__)
-        # 存储cookies和tokens
-        self.cookies = {}
-        self.cf_tokens = {}
+        # 并发检查：阻塞请求放到线程池，信号量限制全局并发数
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='fetch')
+        self.check_semaphore = asyncio.Semaphore(self.max_workers)
+        # 按主机限流，代替固定的随机延迟
+        self.host_scheduler = HostScheduler(self.host_limits)
+        # 条件请求和内容指纹缓存，页面未变化时跳过重复判断
+        self.response_cache = ResponseCache()
+        # 关键词分类器只构建一次，所有检查共用
+        self.classifier = KeywordClassifier()
+        # 平台专用的轻量探测，识别结果按主机缓存
+        self.probes = ProbeRegistry()
+        # 检查中的页面 -> [状态码, 下载耗时, 字节数]
+        self.fetch_records = {}
+        # 按主机缓存 Cloudflare 通行凭证，重启后继续使用
+        self.clearance_cache = ClearanceCache(self.clearance_file, self.logger)
+        self.clearance_cache.load()
+        # 原生异步请求会话（首次使用时创建），以及需要改用 cloudscraper 的主机
+        self.http_session = None
+        self.host_backends = {}
+
+    def restore_state(self):
+        """从数据库恢复上次保存的库存状态"""
+        try:
+            states = self.state_store.load()
+        except Exception as e:
+            self.logger.error(f"读取监控状态失败: {str(e)}")
+            return
+        urls = self.load_urls()
+        for url, state in states.items():
+            if url not in urls:
+                continue
+            self.last_check[url] = state['last_check']
+            if state['last_verdict']:
+                self.verdicts[url] = state['last_verdict']
+            if state['stock_status'] is not None:
+                self.stock_status[url] = state['stock_status']
+                self.notification_count[url] = state['notification_count']
+        try:
+            self.history.restore(self.state_store.load_history(), urls)
+        except Exception as e:
+            self.logger.error(f"读取检查历史失败: {str(e)}")
+        self.warm_start = bool(self.stock_status)
+        if self.warm_start:
+            self.logger.info(f"已恢复 {len(self.stock_status)} 个商品的监控状态")
 
     async def initialize(self):
         """初始化应用"""
@@ -60,8 +2435,9 @@ class VPSMonitor:
             await self.app.bot.get_me()  # 验证 bot token 是否有效
             self.setup_handlers()
             await self.app.start()
-            # 启动轮询
-            await self.app.updater.start_polling()
+            # 启动轮询（集群中只能有一个节点轮询同一个 Bot）
+            if self.telegram_polling:
+                await self.app.updater.start_polling()
             self.logger.info("Telegram Bot 初始化成功")
         except Exception as e:
             self.logger.error(f"Telegram Bot 初始化失败: {str(e)}")
@@ -74,6 +2450,9 @@ class VPSMonitor:
         self.app.add_handler(CommandHandler("help", self.help_command))
         self.app.add_handler(CommandHandler("list", self.list_command))
         self.app.add_handler(CommandHandler("add", self.add_command))
+        self.app.add_handler(CommandHandler("status", self.status_command))
+        self.app.add_handler(CommandHandler("stats", self.stats_command))
+        self.app.add_handler(CommandHandler("history", self.history_command))
         self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_url))
         self.app.add_handler(CallbackQueryHandler(self.button_click))
 
@@ -95,6 +2474,8 @@ class VPSMonitor:
             "/start - 显示此菜单\n"
             "/list - 查看监控列表\n"
             "/add - 添加监控网址\n"
+            "/status - 查看运行状态\n"
+            "/stats - 查看检查成功率和耗时\n"
             "/help - 显示帮助信息\n\n"
             "请选择操作：",
             reply_markup=reply_markup
@@ -108,35 +2489,241 @@ class VPSMonitor:
             "/start - 显示主菜单\n"
             "/list - 查看监控列表\n"
             "/add - 添加监控网址\n"
+            "/status - 查看运行状态和事件循环延迟\n"
+            "/stats - 按商品和主机查看成功率和耗时\n"
+            "/history 编号 - 查看商品的补货和售罄记录\n"
             "/help - 显示此帮助信息\n\n"
             "➕ 添加网址：\n"
             "1. 使用 /add 命令\n"
             "2. 直接输入网址（需以http://或https://开头）\n\n"
             "🗑️ 删除网址：\n"
             "1. 使用 /list 命令查看列表\n"
-            "2. 点击要删除的网址下方的删除按钮\n\n"
+            "2. 点击列表下方对应编号的删除按钮\n\n"
+            "👥 每个聊天（私聊或群组）有自己的监控列表，多个聊天添加同一网址时只检查一次，状态变化会通知所有订阅的聊天\n\n"
             "💡 提示：确保添加的网址格式正确，包含http(s)://"
         )
         await update.message.reply_text(help_text)
 
+    async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /status 命令：运行状态、事件循环延迟、阻塞最久的调用和暂停检查的主机"""
+        uptime = int(time.time() - self.started_at)
+        lines = [
+            "📊 运行状态\n",
+            f"⏱️ 已运行：{uptime // 86400}天{uptime % 86400 // 3600}小时{uptime % 3600 // 60}分钟",
+            f"📝 监控商品：{len(self.registry.by_url)} 个，检查中 {len(self.in_flight)} 个",
+            f"📨 待发送通知：{self.notifier.pending()} 条",
+            f"🔄 事件循环延迟（最近{LoopWatchdog.WINDOW // 60}分钟）：\n{self.watchdog.format_percentiles()}",
+            f"⚠️ 阻塞超过 {self.watchdog.threshold} 秒：{self.watchdog.stalls} 次",
+        ]
+        open_hosts = self.breaker.open_hosts()
+        chat_id = str(update.effective_chat.id)
+        if chat_id != str(self.chat_id):
+            # 管理员以外的聊天只显示自己订阅的商品所在的主机，不泄露其他聊天监控的网址和错误信息
+            hosts = {
+                urllib.parse.urlparse(self.clean_url(url)).netloc.lower()
+                for url in self.registry.by_url if self.registry.is_subscribed(url, chat_id)
+            }
+            open_hosts = {host: state for host, state in open_hosts.items() if host in hosts}
+        if open_hosts:
+            lines.append(f"\n🌐 暂停检查的主机（{len(open_hosts)} 个）：")
+            for host, state in sorted(open_hosts.items(), key=lambda item: item[1]['retry_at']):
+                retry = datetime.fromtimestamp(state['retry_at']).strftime('%H:%M:%S')
+                lines.append(f"• {host}：{state['last_error']}，{retry} 后试探")
+        offenders = self.watchdog.worst_offenders()
+        if offenders:
+            lines.append("\n🐢 阻塞最久的调用：")
+            for location, offender in offenders:
+                lines.append(f"• {location}\n  最长 {offender['worst']:.2f} 秒，共 {offender['count']} 次")
+        await update.message.reply_text("\n".join(lines))
+
+    STATS_ROWS = 10  # /stats 中商品和主机各显示的行数
+
+    @staticmethod
+    def format_summary(summary):
+        total, success_rate, p50, p95 = summary
+        return f"成功率 {success_rate * 100:.0f}%（{total}次），p50 {p50 * 1000:.0f}ms / p95 {p95 * 1000:.0f}ms"
+
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /stats 命令：按商品和主机统计当前聊天订阅商品最近检查的成功率和下载耗时，成功率低的排在前面"""
+        chat_id = str(update.effective_chat.id)
+        urls = {url: name for url, name in self.load_urls().items() if self.registry.is_subscribed(url, chat_id)}
+        overall = self.history.summarize(urls)
+        if overall is None:
+            await update.message.reply_text("📊 暂无检查记录")
+            return
+
+        products = []
+        by_host = {}
+        for url, name in urls.items():
+            summary = self.history.summarize([url])
+            if summary is not None:
+                products.append((summary[1], -summary[3], name, summary))
+            by_host.setdefault(urllib.parse.urlparse(url).netloc.lower(), []).append(url)
+        hosts = []
+        for host, host_urls in by_host.items():
+            summary = self.history.summarize(host_urls)
+            if summary is not None:
+                hosts.append((summary[1], -summary[3], host, summary))
+        products.sort()
+        hosts.sort()
+
+        lines = [f"📊 最近检查统计（每个商品最多 {self.history.capacity} 次）\n", f"全部：{self.format_summary(overall)}"]
+        lines.append(f"\n📦 商品（共 {len(products)} 个）：")
+        for _, _, name, summary in products[:self.STATS_ROWS]:
+            lines.append(f"• {name}\n  {self.format_summary(summary)}")
+        lines.append(f"\n🌐 主机（共 {len(hosts)} 个）：")
+        for _, _, host, summary in hosts[:self.STATS_ROWS]:
+            lines.append(f"• {host}\n  {self.format_summary(summary)}")
+        await update.message.reply_text("\n".join(lines))
+
+    async def history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /history 命令：当前聊天订阅的商品最近的补货和售罄记录"""
+        if not context.args:
+            await update.message.reply_text("用法：/history 编号（编号见 /list）")
+            return
+        entry = self.registry.get_by_id(context.args[0])
+        # 其他聊天的商品按不存在处理，不泄露名称和URL
+        if entry is None or not self.registry.is_subscribed(entry['URL'], update.effective_chat.id):
+            await update.message.reply_text(f"❌ 未找到编号为 {context.args[0]} 的商品")
+            return
+        url = entry['URL']
+        lines = [f"📜 {entry['名称']}\n🔗 {url}\n"]
+        summary = self.history.summarize([url])
+        if summary is None:
+            lines.append("暂无检查记录")
+        else:
+            lines.append(self.format_summary(summary))
+            transitions = self.history.transitions(url)
+            if transitions:
+                lines.append("\n最近的状态变化：")
+                for timestamp, restocked in transitions:
+                    when = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+                    lines.append(f"{'🟢 补货' if restocked else '🔴 售罄'}  {when}")
+            else:
+                lines.append("\n记录期间库存状态没有变化")
+        await update.message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
     async def list_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """处理 /list 命令"""
-        urls_dict = self.load_urls()
-        if not urls_dict:
+        """处理 /list 命令：只列出当前聊天订阅的商品"""
+        chat_id = str(update.effective_chat.id)
+        entries, _ = self.list_index(chat_id)
+        if not entries:
             await update.message.reply_text("📝 当前没有监控的网址")
             return
 
-        await update.message.reply_text("📝 当前监控的网址：")
-        for url, name in urls_dict.items():
-            keyboard = [[InlineKeyboardButton("🗑️ 删除", callback_data=f'delete_{url}')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            message = f"📦 产品：{name}\n🔗 链接：{url}"
-            if url in self.product_configs:
-                message += f"\n⚙️ 配置：{self.product_configs[url].get('配置', '')}"
-            await update.message.reply_text(
-                message,
-                reply_markup=reply_markup
-            )
+        text, reply_markup = self.render_list(chat_id, 'a', 0)
+        await update.message.reply_text(text, reply_markup=reply_markup, disable_web_page_preview=True)
+
+    # /list 每页显示的商品数
+    LIST_PAGE_SIZE = 10
+    HOSTS_PAGE_SIZE = 20
+    # 筛选代码 -> (按钮文字, 判定)
+    LIST_FILTERS = {
+        'a': ("全部", None),
+        'i': ("🟢 有货", 'in_stock'),
+        'o': ("🔴 无货", 'out_of_stock'),
+        'e': ("❗ 异常", 'error')
+    }
+    VERDICT_ICONS = {'in_stock': '🟢', 'out_of_stock': '🔴', 'error': '❗'}
+
+    def list_index(self, chat_id):
+        """该聊天订阅的商品（按ID排序）和主机列表，监控列表变化时重建"""
+        version, entries, hosts = self.list_index_cache.get(chat_id, (None, [], []))
+        if version != self.registry.version:
+            entries = []
+            for id_str, entry in self.registry.by_id.items():
+                url = entry.get('URL', '')
+                if not self.registry.is_subscribed(url, chat_id):
+                    continue
+                entries.append((id_str, url, entry.get('名称', ''), urllib.parse.urlparse(url).netloc.lower()))
+            entries.sort(key=lambda item: (len(item[0]), item[0]))
+            hosts = sorted({host for _, _, _, host in entries})
+            self.list_index_cache[chat_id] = (self.registry.version, entries, hosts)
+        return entries, hosts
+
+    def render_list(self, chat_id, filter_code, page):
+        """生成 /list 的一页：消息文本和翻页、筛选、删除按钮，监控列表和判定不变时复用缓存"""
+        version = (self.registry.version, self.status_version)
+        cached = self.list_cache.get((chat_id, filter_code, page))
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+
+        entries, hosts = self.list_index(chat_id)
+        if filter_code.startswith('h'):
+            host_index = int(filter_code[1:])
+            host = hosts[host_index] if host_index < len(hosts) else ''
+            title = f"🌐 {host}"
+            selected = [item for item in entries if item[3] == host]
+        else:
+            label, verdict = self.LIST_FILTERS.get(filter_code, self.LIST_FILTERS['a'])
+            title = label
+            selected = [item for item in entries if verdict is None or self.verdicts.get(item[1]) == verdict]
+
+        pages = max(1, (len(selected) + self.LIST_PAGE_SIZE - 1) // self.LIST_PAGE_SIZE)
+        page = min(max(page, 0), pages - 1)
+        shown = selected[page * self.LIST_PAGE_SIZE:(page + 1) * self.LIST_PAGE_SIZE]
+
+        lines = [f"📝 监控列表（{title}，共 {len(selected)} 个，第 {page + 1}/{pages} 页）"]
+        for id_str, url, name, _ in shown:
+            lines.append("")
+            lines.append(f"{id_str}. {self.VERDICT_ICONS.get(self.verdicts.get(url), '⏳')} {name}")
+            lines.append(f"🔗 {url if len(url) <= 200 else url[:200] + '…'}")
+            config_info = self.registry.get_config(url)
+            if config_info:
+                lines.append(f"⚙️ {config_info}")
+        if not shown:
+            lines.append("\n没有符合条件的商品")
+
+        keyboard = []
+        # 删除按钮只带商品ID，回调数据远小于 Telegram 的 64 字节限制
+        delete_buttons = [
+            InlineKeyboardButton(f"🗑️ {id_str}", callback_data=f'del:{id_str}:{filter_code}:{page}')
+            for id_str, _, _, _ in shown
+        ]
+        for start in range(0, len(delete_buttons), 5):
+            keyboard.append(delete_buttons[start:start + 5])
+        if pages > 1:
+            keyboard.append([
+                InlineKeyboardButton("◀️", callback_data=f'ls:{filter_code}:{(page - 1) % pages}'),
+                InlineKeyboardButton(f"{page + 1}/{pages}", callback_data='noop'),
+                InlineKeyboardButton("▶️", callback_data=f'ls:{filter_code}:{(page + 1) % pages}')
+            ])
+        keyboard.append([
+            InlineKeyboardButton(label, callback_data=f'ls:{code}:0') for code, (label, _) in self.LIST_FILTERS.items()
+        ])
+        keyboard.append([InlineKeyboardButton("🌐 按主机筛选", callback_data='hosts:0')])
+
+        text = '\n'.join(lines)
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        self.list_cache[(chat_id, filter_code, page)] = (version, text, reply_markup)
+        return text, reply_markup
+
+    def render_hosts(self, chat_id, page):
+        """主机选择页"""
+        _, hosts = self.list_index(chat_id)
+        pages = max(1, (len(hosts) + self.HOSTS_PAGE_SIZE - 1) // self.HOSTS_PAGE_SIZE)
+        page = min(max(page, 0), pages - 1)
+        start = page * self.HOSTS_PAGE_SIZE
+        keyboard = [
+            [InlineKeyboardButton(host, callback_data=f'ls:h{start + offset}:0')]
+            for offset, host in enumerate(hosts[start:start + self.HOSTS_PAGE_SIZE])
+        ]
+        if pages > 1:
+            keyboard.append([
+                InlineKeyboardButton("◀️", callback_data=f'hosts:{(page - 1) % pages}'),
+                InlineKeyboardButton(f"{page + 1}/{pages}", callback_data='noop'),
+                InlineKeyboardButton("▶️", callback_data=f'hosts:{(page + 1) % pages}')
+            ])
+        keyboard.append([InlineKeyboardButton("↩️ 返回列表", callback_data='ls:a:0')])
+        return f"🌐 选择主机（共 {len(hosts)} 个）：", InlineKeyboardMarkup(keyboard)
+
+    async def edit_list_message(self, query, text, reply_markup):
+        """在原消息上翻页，内容没有变化时忽略 Telegram 的报错"""
+        try:
+            await query.edit_message_text(text, reply_markup=reply_markup, disable_web_page_preview=True)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
 
     async def add_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /add 命令"""
@@ -192,20 +2779,35 @@ class VPSMonitor:
             # 先发送处理中的消息
             processing_message = await update.message.reply_text("⏳ 正在处理...")
 
-            # 保存URL和产品名称
-            success, message = self.save_url(name, url, config)
+            # 保存URL和产品名称（为当前聊天订阅）
+            success, message, created = await self.subscribe_url(name, url, str(update.effective_chat.id), config)
             if not success:
                 await processing_message.edit_text(f"❌ {message}")
                 # 重置状态
                 context.user_data.clear()
                 return
 
-            # 立即检查库存状态
-            await processing_message.edit_text("🔍 正在检查库存状态...")
-            stock_available, error = await self.check_stock(url)
+            note = ""
+            if not created:
+                # 其他聊天已在监控该网址：沿用已有的名称和配置，并告知用户
+                entry = self.registry.get(url) or {}
+                existing_name = entry.get('名称') or name
+                if existing_name != name:
+                    note = f"ℹ️ 该网址已以「{existing_name}」的名称监控，已加入你的订阅\n\n"
+                    name = existing_name
+
+            known = None if created or self.verdicts.get(url) == 'error' else self.stock_status.get(url)
+            if known is not None:
+                # 其他聊天已在监控：直接使用最近一次的结果，不重复下载页面
+                stock_available, error = known, None
+            else:
+                # 立即检查库存状态
+                await processing_message.edit_text("🔍 正在检查库存状态...")
+                stock_available, error = await self.check_stock(url)
             
             if error:
                 await processing_message.edit_text(
+                    f"{note}"
                     f"✅ 已添加监控商品：\n"
                     f"📦 产品：{name}\n"
                     f"🔗 链接：{url}\n\n"
@@ -216,6 +2818,7 @@ class VPSMonitor:
             else:
                 status = "🟢 有货" if stock_available else "🔴 无货"
                 await processing_message.edit_text(
+                    f"{note}"
                     f"✅ 已添加监控商品：\n"
                     f"📦 产品：{name}\n"
                     f"🔗 链接：{url}\n\n"
@@ -232,23 +2835,39 @@ class VPSMonitor:
         await query.answer()  # 确认收到回调
 
         try:
+            chat_id = str(update.effective_chat.id)
             if query.data == 'list_urls':
-                urls_dict = self.load_urls()
-                if not urls_dict:
+                entries, _ = self.list_index(chat_id)
+                if not entries:
                     await query.message.reply_text("📝 当前没有监控的网址")
                     return
 
-                await query.message.reply_text("📝 当前监控的网址：")
-                for url, name in urls_dict.items():
-                    keyboard = [[InlineKeyboardButton("🗑️ 删除", callback_data=f'delete_{url}')]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    message = f"📦 产品：{name}\n🔗 链接：{url}"
-                    if url in self.product_configs:
-                        message += f"\n⚙️ 配置：{self.product_configs[url].get('配置', '')}"
-                    await query.message.reply_text(
-                        message,
-                        reply_markup=reply_markup
-                    )
+                text, reply_markup = self.render_list(chat_id, 'a', 0)
+                await query.message.reply_text(text, reply_markup=reply_markup, disable_web_page_preview=True)
+
+            elif query.data.startswith('ls:'):
+                _, filter_code, page = query.data.split(':')
+                await self.edit_list_message(query, *self.render_list(chat_id, filter_code, int(page)))
+
+            elif query.data.startswith('hosts:'):
+                await self.edit_list_message(query, *self.render_hosts(chat_id, int(query.data[6:])))
+
+            elif query.data.startswith('del:'):
+                _, id_str, filter_code, page = query.data.split(':')
+                entry = self.registry.get_by_id(id_str)
+                if entry is None:
+                    await query.message.reply_text("❌ 未找到该商品，可能已被删除")
+                else:
+                    url = entry.get('URL', '')
+                    success, message = await self.unsubscribe_url(url, chat_id)
+                    if success:
+                        await query.message.reply_text(f"✅ 已删除监控网址：\n{url}", disable_web_page_preview=True)
+                    else:
+                        await query.message.reply_text(f"❌ {message}")
+                await self.edit_list_message(query, *self.render_list(chat_id, filter_code, int(page)))
+
+            elif query.data == 'noop':
+                pass
 
             elif query.data == 'add_url':
                 context.user_data['adding_url'] = True
@@ -273,14 +2892,15 @@ class VPSMonitor:
                     "2. 直接输入网址（需以http://或https://开头）\n\n"
                     "🗑️ 删除网址：\n"
                     "1. 使用 /list 命令查看列表\n"
-                    "2. 点击要删除的网址下方的删除按钮\n\n"
+                    "2. 点击列表下方对应编号的删除按钮\n\n"
                     "💡 提示：确保添加的网址格式正确，包含http(s)://"
                 )
                 await query.message.reply_text(help_text)
 
             elif query.data.startswith('delete_'):
+                # 旧版列表消息中的删除按钮
                 url = query.data[7:]  # 删除'delete_'前缀
-                success, message = self.remove_url(url)
+                success, message = await self.unsubscribe_url(url, chat_id)
                 if success:
                     await query.message.reply_text(f"✅ 已删除监控网址：\n{url}")
                 else:
@@ -290,8 +2910,11 @@ class VPSMonitor:
             self.logger.error(f"处理按钮点击时出错: {str(e)}")
             await query.message.reply_text("❌ 操作失败，请重试")
 
+    # 不影响页面内容的跟踪参数
+    TRACKING_PARAMS = ('gclid', 'fbclid', 'msclkid', 'yclid', '_ga', 'mc_cid', 'mc_eid')
+
     def clean_url(self, url):
-        """清理URL，移除Cloudflare token等参数"""
+        """清理URL，移除Cloudflare token和跟踪参数等"""
         try:
             # 解析URL
             parsed = urllib.parse.urlparse(url)
@@ -307,6 +2930,11 @@ class VPSMonitor:
             ]
             for param in cf_params:
                 query_params.pop(param, None)
+
+            # 移除推广跟踪参数，避免同一页面因跟踪参数不同而重复下载
+            for param in list(query_params):
+                if param.startswith('utm_') or param in self.TRACKING_PARAMS:
+                    query_params.pop(param, None)
             
             # 重建查询字符串
             clean_query = urllib.parse.urlencode(query_params, doseq=True)
@@ -326,15 +2954,315 @@ class VPSMonitor:
             self.logger.error(f"清理URL时出错: {str(e)}")
             return url
 
+    async def fetch_page(self, url, headers, early_verdict=True, allow_redirects=True, scan_keywords=True):
+        """下载页面：默认走 aiohttp，遇到 Cloudflare 挑战的主机改用 cloudscraper 并记住该选择"""
+        host = urllib.parse.urlparse(url).netloc.lower()
+        # 已持有 Cloudflare 凭证的主机直接走 cloudscraper
+        if (self.http_backend != 'cloudscraper' and self.host_backends.get(host) != 'cloudscraper'
+                and not self.clearance_cache.has(host)):
+            result = await self.fetch_with_aiohttp(url, headers, early_verdict, allow_redirects, scan_keywords)
+            if result is not None:
+                return result
+            self.host_backends[host] = 'cloudscraper'
+            self.logger.info(f"{host} 返回了Cloudflare挑战，此后改用 cloudscraper 请求")
+
+        # 阻塞请求和流式读取都放到线程池执行，避免卡住事件循环
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(
+                self.fetch_with_cloudscraper, url, headers, early_verdict, allow_redirects, scan_keywords
+            )
+        )
+
+    def get_http_session(self):
+        """共享的 aiohttp 会话：连接池、keep-alive、DNS缓存，自动解压 gzip/br"""
+        if self.http_session is None or self.http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_workers,
+                limit_per_host=0,  # 单主机并发由 HostScheduler 控制
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            )
+            self.http_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30),
+                cookie_jar=aiohttp.CookieJar(unsafe=True)
+            )
+        return self.http_session
+
+    @staticmethod
+    def is_cloudflare_challenge(status, response_headers):
+        """根据状态码和响应头判断是否为 Cloudflare 挑战页面"""
+        if response_headers.get('cf-mitigated', '').lower() == 'challenge':
+            return True
+        server = response_headers.get('Server', '').lower()
+        return status in (403, 429, 503) and server.startswith('cloudflare')
+
+    async def fetch_with_aiohttp(self, url, headers, early_verdict=True, allow_redirects=True, scan_keywords=True):
+        """用 aiohttp 流式下载页面并增量扫描，遇到 Cloudflare 挑战时返回 None"""
+        session = self.get_http_session()
+        async with session.get(url, headers=headers, allow_redirects=allow_redirects) as response:
+            if self.is_cloudflare_challenge(response.status, response.headers):
+                return None
+            scanner = None
+            if response.status == 200:
+                scanner = PageScanner(
+                    self.classifier,
+                    PageScanner.header_encoding(response.headers.get('Content-Type')),
+                    self.max_page_bytes,
+                    early_verdict,
+                    scan_keywords
+                )
+                # 事件循环只负责接收数据，解码和关键词扫描与 cloudscraper 一样放到线程池执行；
+                # 已缓冲的数据 iter_chunked 会连续返回而不让出事件循环，在本线程扫描会卡住其它任务
+                loop = asyncio.get_running_loop()
+                async for chunk in response.content.iter_chunked(PageScanner.CHUNK_SIZE):
+                    if await loop.run_in_executor(self.executor, scanner.feed, chunk):
+                        break
+                await loop.run_in_executor(self.executor, scanner.finish)
+                if scanner.cloudflare:
+                    return None
+            return response.status, response.headers, scanner
+
+    def fetch_with_cloudscraper(self, url, headers, early_verdict=True, allow_redirects=True, scan_keywords=True):
+        """用 cloudscraper 流式下载页面并增量扫描（阻塞，在线程池中执行），返回 (状态码, 响应头, 扫描结果)"""
+        host = urllib.parse.urlparse(url).netloc.lower()
+        # 复用该主机已有的 Cloudflare 通行凭证，User-Agent 必须与签发时一致
+        clearance = self.clearance_cache.get(host)
+        cookies = None
+        if clearance:
+            headers = {**headers, 'User-Agent': clearance['user_agent']}
+            cookies = clearance['cookies']
+
+        response = self.scraper.get(
+            url, headers=headers, cookies=cookies, timeout=30, stream=True, allow_redirects=allow_redirects
+        )
+        try:
+            scanner = None
+            if response.status_code == 200:
+                scanner = PageScanner(
+                    self.classifier,
+                    PageScanner.header_encoding(response.headers.get('Content-Type')),
+                    self.max_page_bytes,
+                    early_verdict,
+                    scan_keywords
+                )
+                for chunk in response.iter_content(chunk_size=PageScanner.CHUNK_SIZE):
+                    if scanner.feed(chunk):
+                        break
+                scanner.finish()
+
+            passed = response.status_code in (200, 304) and not (scanner and scanner.cloudflare)
+            self.clearance_cache.update(host, self.scraper.cookies, headers['User-Agent'], clearance, passed)
+            return response.status_code, response.headers, scanner
+        finally:
+            response.close()
+
     async def check_stock(self, url):
         """检查单个URL的库存状态"""
+        results = await self.check_group(self.clean_url(url), [url])
+        return results[url]
+
+    async def check_group(self, fetch_url, urls):
+        """检查共用一个页面的商品，多进程模式下交给负责该主机的工作进程"""
+        host = urllib.parse.urlparse(fetch_url).netloc.lower()
+        try:
+            if self.worker_pool is None:
+                results = await self.check_page(fetch_url, urls)
+                record = self.fetch_records.pop(fetch_url, None)
+            else:
+                results, changed, record = await self.worker_pool.check(fetch_url, urls)
+                if changed:
+                    # 页面变化记录在工作进程中，这里同步一份供调度器判断页面是否频繁变动
+                    self.response_cache.changed.add(fetch_url)
+        except asyncio.CancelledError:
+            # 请求已发出但超出本轮时间预算，按主机无响应处理；仍在排队的不计入
+            record = self.fetch_records.pop(fetch_url, None)
+            if record is not None and record[0] == -1:
+                await self.record_host_result(host, False, "检查超时")
+            raise
+        status, latency, size = record or (0, 0.0, 0)
+        for url, (stock_available, error) in results.items():
+            self.history.record(url, stock_available, error, status, latency, size)
+        if record is not None:
+            # 有响应（包括跳转）即说明主机可以访问，页面内容的问题不计入熔断
+            error = next((error for _, error in results.values() if error), '')
+            await self.record_host_result(host, 200 <= status < 400, error)
+        return results
+
+    async def record_host_result(self, host, ok, error):
+        """记录主机的请求结果，开始熔断和恢复时各通知一次"""
+        event = self.breaker.record(host, ok, error, time.time())
+        # 通知订阅了该主机任一商品的聊天
+        chats = set()
+        if event:
+            for url in self.registry.by_url:
+                if urllib.parse.urlparse(url).netloc.lower() == host:
+                    chats.update(self.registry.get_subscribers(url))
+        if event == 'opened':
+            state = self.breaker.hosts[host]
+            self.logger.warning(f"主机 {host} 连续 {state['failures']} 个页面检查失败，暂停检查 {state['backoff']} 秒")
+            await self.send_telegram_notification(
+                f"🌐 主机 {host} 暂时无法访问\n"
+                f"❗ 最近的错误：{error}\n"
+                f"已暂停检查该主机的商品，约 {state['backoff']} 秒后试探，恢复前不再逐个通知检查失败",
+                chats=sorted(chats)
+            )
+        elif event == 'recovered':
+            self.logger.info(f"主机 {host} 已恢复访问")
+            await self.send_telegram_notification(f"✅ 主机 {host} 已恢复访问，继续检查", chats=sorted(chats))
+
+    def admit_hosts(self, urls, probes):
+        """过滤掉熔断中主机的URL并改到可以试探的时间；熔断到期的主机只放行一个页面试探，记入 probes {主机: 试探序号}"""
+        now = time.time()
+        pages = {}
+        for url in urls:
+            pages.setdefault(self.clean_url(url), []).append(url)
+        admitted = []
+        for fetch_url, page_urls in pages.items():
+            host = urllib.parse.urlparse(fetch_url).netloc.lower()
+            allowed, retry_at = self.breaker.admit(host, now)
+            if allowed:
+                admitted.extend(page_urls)
+                if self.breaker.is_open(host):
+                    probes[host] = self.breaker.hosts[host]['probe']
+                continue
+            for url in page_urls:
+                self.scheduler.schedule(url, max(retry_at, now) + random.uniform(0, self.dispatch_window))
+        return admitted
+
+    def classify_selected(self, content, selectors):
+        """按各商品的选择器（{URL: 选择器}）取出元素文本分别判断，页面只解析一次"""
+        results = {}
+        compiled = {}
+        for url, source in selectors.items():
+            try:
+                compiled[url] = Selector.compile(source)
+            except ValueError as e:
+                results[url] = (None, str(e))
+        if not compiled:
+            return results
+
+        distinct = list(dict.fromkeys(compiled.values()))
+        texts = dict(zip(distinct, ScopedExtractor(distinct).extract(content)))
+        for url, selector in compiled.items():
+            text = texts[selector]
+            if text is None:
+                results[url] = (None, f"页面中未找到选择器：{selector.source}")
+                continue
+            categories = self.classifier.find_categories(text)
+            # 页面长度用于排除错误页面，仍按整个页面计算
+            results[url] = self.classifier.decide(categories, len(content))
+        return results
+
+    def classify_sections(self, content, categories, urls, selectors, anchors):
+        """设置了选择器的商品按元素文本判断，其余按锚点截取页面片段判断，都没有时按整个页面判断
+
+        selectors / anchors 由调用方在事件循环中从监控列表取出，本方法不访问监控列表，可以在线程池中执行。
+        """
+        results = self.classify_selected(content, selectors)
+        positions = {url: content.find(anchor) for url, anchor in anchors.items()}
+        starts = sorted(position for position in positions.values() if position != -1)
+
+        for url in urls:
+            if url in results:
+                continue
+            if url not in anchors:
+                results[url] = self.classifier.decide(categories, len(content))
+                continue
+            start = positions[url]
+            if start == -1:
+                results[url] = (None, f"页面中未找到锚点：{anchors[url]}")
+                continue
+            # 片段到下一个商品的锚点或 section_length 为止
+            end = start + self.section_length
+            for other in starts:
+                if other > start:
+                    end = min(end, other)
+                    break
+            section = content[start:end]
+            section_categories = self.classifier.find_categories(section)
+            # 页面长度用于排除错误页面，仍按整个页面计算
+            results[url] = self.classifier.decide(section_categories, len(content))
+        return results
+
+    def count_results(self, results):
+        """按判定结果累计检查次数"""
+        for stock_available, error in results.values():
+            if error:
+                result = 'undetermined' if stock_available is False else 'error'
+            else:
+                result = 'in_stock' if stock_available else 'out_of_stock'
+            self.metrics.inc('vpsmonitor_checks', result=result)
+        return results
+
+    async def fetch_limited(self, url, headers, early_verdict, allow_redirects=True, scan_keywords=True, record=None):
+        """按主机限流和全局并发名额下载页面，并记录各阶段耗时
+
+        record 为 [状态码, 下载耗时, 字节数] 时累计本次下载，用于检查历史
+        """
+        host = urllib.parse.urlparse(url).netloc.lower()
+        # 先按主机排队，轮到后再占用全局并发名额，避免慢主机占满所有工作位
+        queued = time.perf_counter()
+        async with self.host_scheduler.slot(url):
+            async with self.check_semaphore:
+                started = time.perf_counter()
+                self.metrics.observe('vpsmonitor_check_stage_seconds', started - queued, stage='queue_wait')
+                self.metrics.inc('vpsmonitor_in_flight_checks', host=host)
+                if record is not None:
+                    # 请求已发出：本轮超时取消时据此区分主机无响应和排队未轮到
+                    record[0] = -1
+                try:
+                    status_code, response_headers, scanner = await self.fetch_page(
+                        url, headers, early_verdict, allow_redirects, scan_keywords
+                    )
+                except Exception:
+                    if record is not None:
+                        record[0] = 0
+                    raise
+                finally:
+                    self.metrics.inc('vpsmonitor_in_flight_checks', -1, host=host)
+                fetched = time.perf_counter()
+
+        # 下载时边读边解码、匹配关键词，网络耗时要扣除这两部分
+        decode_time = scanner.decode_time if scanner else 0.0
+        scan_time = scanner.scan_time if scanner else 0.0
+        self.metrics.observe('vpsmonitor_check_stage_seconds', fetched - started - decode_time - scan_time, stage='fetch')
+        if scanner:
+            self.metrics.observe('vpsmonitor_check_stage_seconds', decode_time, stage='decode')
+            self.metrics.inc('vpsmonitor_downloaded_bytes', scanner.bytes_read, host=host)
+        if record is not None:
+            record[0] = status_code
+            record[1] += fetched - started
+            record[2] += scanner.bytes_read if scanner else 0
+        return status_code, response_headers, scanner
+
+    async def run_json_probe(self, probe, url, json_url, headers, record=None):
+        """请求平台的 JSON 接口判断库存，无法确定时返回 None"""
+        json_headers = {
+            key: value for key, value in headers.items()
+            if key not in ('If-None-Match', 'If-Modified-Since')
+        }
+        json_headers['Accept'] = 'application/json'
+        try:
+            status_code, _, scanner = await self.fetch_limited(json_url, json_headers, False, record=record)
+            if status_code != 200 or scanner is None or scanner.truncated:
+                return None
+            return probe.interpret_json(url, json.loads(scanner.text))
+        except Exception as e:
+            self.logger.warning(f"{probe.name} 接口探测失败，改用页面判断: {str(e)}")
+            return None
+
+    async def check_page(self, fetch_url, urls):
+        """下载一次页面，分别判断共用该页面的各个商品，返回 {url: (stock_available, error)}"""
+        def fail(error, result='error'):
+            self.metrics.inc('vpsmonitor_checks', len(urls), result=result)
+            return {url: (None, error) for url in urls}
+
+        # 本次检查的 [状态码, 下载耗时, 字节数]，由 check_group 取出写入检查历史
+        record = self.fetch_records[fetch_url] = [0, 0.0, 0]
         try:
-            # 添加随机延迟
-            await asyncio.sleep(random.uniform(2, 5))
-            
-            # 清理URL
-            clean_url = self.clean_url(url)
-            
             # 基础请求头
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -352,86 +3280,420 @@ class VPSMonitor:
                 'Upgrade-Insecure-Requests': '1',
                 'Connection': 'keep-alive'
             }
+            # 带上 If-None-Match / If-Modified-Since，页面未变化时服务器可直接返回304
+            headers.update(self.response_cache.conditional_headers(fetch_url))
+            # 多个商品共用页面或设置了锚点、选择器时需要完整页面，不能提前结束
+            selectors = [self.registry.get_selector(url) for url in urls]
+            sectioned = len(urls) > 1 or any(selectors) or any(self.registry.get_anchor(url) for url in urls)
+            # 所有商品都只按选择器范围判断时，下载过程中不必匹配整个页面的关键词
+            scan_keywords = not all(selectors)
 
+            # 已识别平台的单个商品先用更小的接口或跳转判断
+            probe = None if sectioned else self.probes.select(fetch_url)
             try:
-                response = self.scraper.get(clean_url, headers=headers, timeout=30)
+                json_url = probe.json_url(fetch_url) if probe is not None and probe.json_endpoint else None
+                if json_url is not None:
+                    result = await self.run_json_probe(probe, urls[0], json_url, headers, record)
+                    self.metrics.inc('vpsmonitor_probe_checks', platform=probe.name,
+                                     result='fallback' if result is None else 'definitive')
+                    if result is not None:
+                        return self.count_results({urls[0]: result})
+
+                redirect_probe = probe is not None and probe.redirect_probe
+                status_code, response_headers, scanner = await self.fetch_limited(
+                    fetch_url, headers, self.early_verdict and not sectioned,
+                    allow_redirects=not redirect_probe, scan_keywords=scan_keywords, record=record
+                )
+                if redirect_probe:
+                    result = None
+                    if 300 <= status_code < 400:
+                        result = probe.interpret_redirect(response_headers.get('Location', ''))
+                    self.metrics.inc('vpsmonitor_probe_checks', platform=probe.name,
+                                     result='fallback' if result is None else 'definitive')
+                    if result is not None:
+                        return self.count_results({urls[0]: result})
+                    if 300 <= status_code < 400:
+                        # 跳转到未知页面：按普通页面重新请求
+                        status_code, response_headers, scanner = await self.fetch_limited(
+                            fetch_url, headers, self.early_verdict, record=record
+                        )
+                scan_time = scanner.scan_time if scanner else 0.0
+
+                # 页面未修改，直接复用上次的判定结果
+                if status_code == 304:
+                    cached = self.response_cache.not_modified(fetch_url, urls)
+                    if cached is not None:
+                        return self.count_results(cached)
+                    return fail("请求失败 (HTTP 304，但没有缓存的页面)", 'http_error')
                 
                 # 检查是否成功获取页面
-                if not response or response.status_code != 200:
-                    return None, f"请求失败 (HTTP {response.status_code if response else 'No response'})"
-                
-                # 获取页面内容，尝试处理不同的编码
-                try:
-                    content = response.text.lower()
-                except UnicodeDecodeError:
-                    try:
-                        content = response.content.decode('utf-8').lower()
-                    except UnicodeDecodeError:
-                        try:
-                            content = response.content.decode('latin1').lower()
-                        except UnicodeDecodeError:
-                            return None, "无法解码页面内容"
+                if status_code != 200:
+                    blocked = self.is_cloudflare_challenge(status_code, response_headers)
+                    return fail(f"请求失败 (HTTP {status_code})", 'cloudflare' if blocked else 'http_error')
+
+                content = scanner.text
                 
                 # 检查内容是否为空或过短
                 if not content or len(content.strip()) < 100:
-                    return None, "页面内容为空或过短"
+                    return fail("页面内容为空或过短")
                 
                 # 如果页面包含Cloudflare验证页面的特征，认为请求失败
-                if 'just a moment' in content or 'checking if the site connection is secure' in content:
-                    return None, "无法绕过Cloudflare保护，将在下次检查时重试"
-                
-                # 检查页面内容是否包含缺货关键词
-                out_of_stock_keywords = [
-                    'sold out', 'out of stock', '缺货', '售罄', '补货中',
-                    'currently unavailable', 'not available', '暂时缺货',
-                    'temporarily out of stock', '已售完', '库存不足',
-                    'out-of-stock', 'unavailable', '无货', '断货',
-                    'not in stock', 'no stock', '无库存', 'stock: 0',
-                    'sorry', 'Sorry, this item is currently unavailable'
-                ]
-                
-                # 检查页面内容是否包含有货关键词
-                in_stock_keywords = [
-                    'add to bag', 'buy now', '立即购买', '加入购物车',
-                    'in stock', '有货', '现货', 'available', 'order now',
-                    'purchase', 'checkout', '订购', '下单', '继续', '繼續',
-                    'configure', 'select options', 'stock: 1', 'stock: 2',
-                    'stock: 3', 'stock: 4', 'stock: 5', 'configure now','Continue'
-                ]
-                
-                # 检查是否存在订单表单和价格选择器（通常表示可以购买）
-                order_indicators = [
-                    'form', 'price', 'quantity', 'payment', 'checkout',
-                    'cart', 'billing', '价格', '数量', '支付',
-                    'order form', 'purchase form', 'configure now'
-                ]
-                
-                # 检查各种状态指标
-                is_out_of_stock = any(keyword in content for keyword in out_of_stock_keywords)
-                is_in_stock = any(keyword in content for keyword in in_stock_keywords)
-                has_order_form = any(indicator in content for indicator in order_indicators)
+                if scanner.cloudflare:
+                    return fail("无法绕过Cloudflare保护，将在下次检查时重试", 'cloudflare')
+
+                # 未识别的主机用首个完整页面识别平台，之后的检查使用对应的探测方式
+                if not scanner.stopped_early:
+                    self.probes.learn(fetch_url, response_headers, content)
                 
-                # 检测库存状态
-                if not is_out_of_stock and (is_in_stock or has_order_form) and len(content) > 1000:
-                    return True, None
-                elif is_out_of_stock:
-                    return False, None
+                # 内容指纹与上次一致时直接复用上次的判定结果
+                # 归一化要扫描整个页面，与解码、扫描一样放到线程池
+                fingerprint = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.response_cache.fingerprint, content
+                )
+                cached = self.response_cache.lookup(fetch_url, fingerprint, urls)
+                if cached is not None:
+                    return self.count_results(cached)
+
+                classify_started = time.perf_counter()
+                if sectioned:
+                    selectors = {url: self.registry.get_selector(url) for url in urls if self.registry.get_selector(url)}
+                    anchors = {url: self.registry.get_anchor(url) for url in urls if self.registry.get_anchor(url)}
+                    classify = functools.partial(self.classify_sections, content, scanner.categories, urls, selectors, anchors)
+                    if selectors:
+                        # 选择器需要解析整个HTML（2MB页面约0.4秒），和下载、解码一样放到线程池执行
+                        results = await asyncio.get_running_loop().run_in_executor(self.executor, classify)
+                    else:
+                        results = classify()
                 else:
-                    return False, "无法确定库存状态"
+                    # 关键词已在下载过程中增量匹配，这里只需汇总判定
+                    results = {urls[0]: self.classifier.decide(scanner.categories, len(content))}
+                self.metrics.observe(
+                    'vpsmonitor_check_stage_seconds', scan_time + time.perf_counter() - classify_started, stage='classify'
+                )
+                self.response_cache.store(fetch_url, response_headers, fingerprint, results, scanner.bytes_read)
+                return self.count_results(results)
             
             except Exception as e:
                 self.logger.error(f"检查失败: {str(e)}")
-                return None, f"检查失败: {str(e)}"
+                return fail(f"检查失败: {str(e)}")
         
         except Exception as e:
             self.logger.error(f"检查失败: {str(e)}")
-            return None, f"检查失败: {str(e)}"
+            return fail(f"检查失败: {str(e)}")
+
+    async def run_check_cycle(self, urls_dict):
+        """并发检查一批URL，返回 {url: (stock_available, error)}"""
+        results = {}
+        start_time = time.monotonic()
+
+        # 按清理后的URL分组，同一页面只下载一次
+        groups = {}
+        for url in urls_dict:
+            groups.setdefault(self.clean_url(url), []).append(url)
+
+        async def check_one(fetch_url, urls):
+            # 并发名额和主机限流都在 check_page 内部处理
+            results.update(await self.check_group(fetch_url, urls))
+
+        tasks = {asyncio.create_task(check_one(fetch_url, urls)): urls for fetch_url, urls in groups.items()}
+        pending = set()
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=self.cycle_timeout)
+            # 超出本轮预算的检查直接取消，下一轮再试
+            for task in pending:
+                task.cancel()
+                for url in tasks[task]:
+                    results[url] = (None, "检查超时，本轮已取消")
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in done:
+                if task.exception():
+                    for url in tasks[task]:
+                        self.logger.error(f"检查URL {url} 时出错: {str(task.exception())}")
+                        results[url] = (None, f"检查失败: {str(task.exception())}")
+
+        elapsed = time.monotonic() - start_time
+        self.metrics.observe('vpsmonitor_cycle_seconds', elapsed)
+        if pending:
+            self.metrics.inc('vpsmonitor_checks', sum(len(tasks[task]) for task in pending), result='timeout')
+        self.logger.info(
+            f"本轮检查完成: {len(urls_dict)} 个URL（{len(groups)} 个页面），"
+            f"耗时 {elapsed:.1f} 秒 / 预算 {self.cycle_timeout} 秒，"
+            f"并发 {self.max_workers}，超时取消 {len(pending)} 个"
+        )
+        self.logger.info(f"响应缓存: {self.response_cache.summary()}")
+        self.logger.info(f"Cloudflare: {self.clearance_cache.summary()}")
+        if pending:
+            self.logger.warning(f"本轮有 {len(pending)} 个检查超出时间预算，请调大 max_workers 或 cycle_timeout")
+        return results
+
+    async def process_result(self, url, name, stock_available, error):
+        """处理单个商品的检查结果：记录状态，状态变化时发送通知
+
+        返回 error / flip / stable，供调度器调整检查间隔
+        """
+        if error:
+            # 如果检查出错，记录错误但继续监控
+            self.logger.error(f"检查URL {url} 时出错: {error}")
+            already_failing = self.verdicts.get(url) == 'error'
+            self.record_state(url, self.stock_status.get(url), error)
+            # 每次故障只通知一次：连续失败不重复通知，主机熔断时已按主机通知
+            if already_failing or self.breaker.is_open(urllib.parse.urlparse(url).netloc.lower()):
+                return 'error'
+            await self.send_telegram_notification(
+                f"📦 产品：{name}\n"
+                f"🔗 链接：{url}\n"
+                f"❗ 检查失败: {error}\n"
+                "将在下一个检查周期重试",
+                digest=True,
+                chats=self.registry.get_subscribers(url)
+            )
+            return 'error'
+
+        # 初始化状态
+        if url not in self.stock_status:
+            self.stock_status[url] = stock_available
+            self.notification_count[url] = 0
+            self.record_state(url, stock_available, error)
+            return 'stable'
+
+        outcome = 'stable'
+
+        # 状态变化检测和通知逻辑
+        if stock_available != self.stock_status[url]:
+            message = (
+                f"📦 产品：{name}\n"
+                f"🔗 链接：{url}\n"
+            )
+            config_info = self.registry.get_config(url)
+            if config_info:
+                message += f"⚙️ 配置：{config_info}\n"
+
+            if stock_available:
+                # 从无货变为有货
+                message += "📊 状态：🟢 补货啦！商品已经有货"
+                self.notification_count[url] = 1
+            else:
+                # 从有货变为无货
+                message += "📊 状态：🔴 已经无货"
+                self.notification_count[url] = 0
+
+            await self.send_telegram_notification(message, digest=True, chats=self.registry.get_subscribers(url))
+            self.stock_status[url] = stock_available
+            outcome = 'flip'
+
+        # 持续有货的通知逻辑（最多通知3次）
+        elif stock_available and self.notification_count[url] < 3:
+            message = (
+                f"📦 产品：{name}\n"
+                f"🔗 链接：{url}\n"
+            )
+            config_info = self.registry.get_config(url)
+            if config_info:
+                message += f"⚙️ 配置：{config_info}\n"
+            message += f"📊 状态：🟢 仍然有货 (通知 {self.notification_count[url] + 1}/3)"
+            await self.send_telegram_notification(message, digest=True, chats=self.registry.get_subscribers(url))
+            self.notification_count[url] += 1
+
+        self.record_state(url, stock_available, error)
+        return outcome
+
+    def record_state(self, url, stock_available, error):
+        """记录商品最新状态，等本轮结束后统一写入数据库"""
+        now = time.time()
+        self.last_check[url] = now
+        if error:
+            verdict = 'error'
+        else:
+            verdict = 'in_stock' if stock_available else 'out_of_stock'
+        if self.verdicts.get(url) != verdict:
+            self.verdicts[url] = verdict
+            self.status_version += 1
+        self.dirty_state[url] = (
+            url,
+            self.stock_status.get(url),
+            self.notification_count.get(url, 0),
+            now,
+            verdict,
+            error
+        )
+
+    async def flush_state(self):
+        """把本轮变化的状态批量写入数据库（在线程池中执行）"""
+        if not self.dirty_state:
+            return
+        rows = list(self.dirty_state.values())
+        self.dirty_state = {}
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.state_store.save_many, rows)
+        except Exception as e:
+            self.logger.error(f"保存监控状态失败: {str(e)}")
+
+    async def save_history(self):
+        """保存检查历史快照（在线程池中执行）"""
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.state_store.save_history, self.history.snapshot())
+        except Exception as e:
+            self.logger.error(f"保存检查历史失败: {str(e)}")
+
+    def registry_entries(self):
+        """当前监控列表 {URL: 条目}"""
+        return {url: self.registry.get(url) for url in self.registry.by_url}
+
+    async def claim_leases(self, urls):
+        """集群模式：为到期的URL申请租约，返回取得租约的URL；其余URL改到租约到期后再尝试"""
+        try:
+            leases = await self.cluster.claim(
+                {url: self.scheduler.intervals.get(url, self.check_interval) for url in urls}, self.node_id
+            )
+            states = await self.cluster.load_states([url for url, (claimed, _) in leases.items() if claimed])
+        except Exception as e:
+            self.logger.error(f"申请检查租约失败: {str(e)}")
+            return []
+        claimed = []
+        for url, (ok, expires) in leases.items():
+            if not ok:
+                # 其它节点本周期负责检查，到期后加少量随机延迟再竞争
+                self.scheduler.schedule(url, expires + random.uniform(0, self.dispatch_window))
+                continue
+            claimed.append(url)
+            # 以共享状态为准判断是否变化，其它节点已通知过的变化不会重复通知
+            if url in states:
+                stock_status, notification_count = states[url]
+                if stock_status is None:
+                    self.stock_status.pop(url, None)
+                else:
+                    self.stock_status[url] = stock_status
+                self.notification_count[url] = notification_count
+        return claimed
+
+    async def run_batch(self, urls):
+        """检查一批到期的URL，处理结果并安排各自的下次检查"""
+        probes = {}
+        try:
+            admitted = self.admit_hosts(urls, probes)
+            claimed = await self.claim_leases(admitted) if self.cluster else admitted
+            urls_dict = {url: self.registry.get(url).get('名称', '') for url in claimed if self.registry.get(url)}
+            results = await self.run_check_cycle(urls_dict)
+            if self.cluster:
+                # 检查耗时超过租约、已被其它节点接手的URL不再处理，避免重复通知
+                try:
+                    held = await self.cluster.held(urls_dict, self.node_id)
+                except Exception as e:
+                    self.logger.error(f"确认检查租约失败: {str(e)}")
+                    held = set()
+                for url in set(urls_dict) - held:
+                    del urls_dict[url]
+                    self.scheduler.update(url, 'stable', time.time())
+            # 共用页面的商品只查询一次页面是否有变化
+            changed_pages = {
+                fetch_url for fetch_url in {self.clean_url(url) for url in urls_dict}
+                if self.response_cache.pop_changed(fetch_url)
+            }
+            for url, name in urls_dict.items():
+                try:
+                    stock_available, error = results[url]
+                    outcome = await self.process_result(url, name, stock_available, error)
+                    if outcome == 'stable' and self.clean_url(url) in changed_pages:
+                        outcome = 'volatile'
+                    self.scheduler.update(url, outcome, time.time())
+                except Exception as e:
+                    self.logger.error(f"检查URL {url} 时出错: {str(e)}")
+                    self.scheduler.update(url, 'error', time.time())
+            if self.cluster and urls_dict:
+                try:
+                    await self.cluster.save_states({
+                        url: (self.stock_status.get(url), self.notification_count.get(url, 0)) for url in urls_dict
+                    }, self.node_id)
+                except Exception as e:
+                    self.logger.error(f"保存共享状态失败: {str(e)}")
+            await self.flush_state()
+            await self.save_clearances()
+            # 定期保存检查历史，进程被强制结束时最多丢失一个间隔的记录
+            if time.monotonic() - self.history_saved_at >= self.HISTORY_SAVE_INTERVAL:
+                self.history_saved_at = time.monotonic()
+                await self.save_history()
+            # 本批的状态变化合并成摘要发送
+            self.notifier.flush_digests()
+        finally:
+            # 试探页面没有记录到结果（超时前仍在排队、租约被其它节点取得、没有可用的工作进程等）时交还试探名额
+            for host, probe in probes.items():
+                self.breaker.release(host, probe, time.time())
+            self.in_flight.difference_update(urls)
+            # 异常中断时未安排下次检查的URL按当前间隔重新排期
+            for url in urls:
+                if url not in self.scheduler.due and url in self.scheduler.intervals:
+                    self.scheduler.update(url, 'error', time.time())
+            self.dispatch_event.set()
+
+    def page_groups(self):
+        """按清理后的URL分组的监控列表 {页面URL: [URL, ...]}"""
+        groups = {}
+        for url in self.registry.by_url:
+            groups.setdefault(self.clean_url(url), []).append(url)
+        return groups
+
+    async def start_metrics_server(self):
+        """在本地端口提供 OpenMetrics 格式的 /metrics 接口"""
+        app = web.Application()
+        app.router.add_get('/metrics', self.metrics_handler)
+        self.metrics_runner = web.AppRunner(app, access_log=None)
+        await self.metrics_runner.setup()
+        site = web.TCPSite(self.metrics_runner, self.metrics_host, self.metrics_port)
+        await site.start()
+        self.logger.info(f"指标接口已启动: http://{self.metrics_host}:{self.metrics_port}/metrics")
+
+    async def metrics_handler(self, request):
+        """返回当前指标，队列长度等瞬时值在请求时读取"""
+        self.metrics.set('vpsmonitor_notification_queue', self.notifier.pending())
+        self.metrics.set('vpsmonitor_monitored_urls', len(self.registry.by_url))
+        self.metrics.set('vpsmonitor_open_circuits', len(self.breaker.open_hosts()))
+        metrics = self.metrics
+        if self.worker_pool:
+            # 合并各工作进程上报的下载和判定指标
+            self.metrics.set('vpsmonitor_worker_processes', len(self.worker_pool.live_workers()))
+            metrics = Metrics()
+            metrics.merge(self.metrics.samples)
+            for samples in self.worker_pool.metrics.values():
+                metrics.merge(samples)
+        return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': Metrics.CONTENT_TYPE})
+
+    async def save_clearances(self):
+        """保存有变化的Cloudflare凭证（在线程池中执行）"""
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.clearance_cache.save)
+        except Exception as e:
+            self.logger.error(f"保存Cloudflare凭证失败: {str(e)}")
 
     async def monitor(self):
         """主监控循环"""
         try:
             # 初始化 Telegram Bot
             await self.initialize()
+
+            # 监视事件循环延迟
+            self.watchdog.start()
+
+            # 启动发送任务
+            self.notifier_task = asyncio.create_task(self.notifier.run(self.app.bot))
+
+            # 后台监视 urls.json 的变化（例如通过菜单脚本添加/删除）
+            self.registry_task = asyncio.create_task(
+                self.registry.watch(self.urls_reload_interval, self.urls_compact_interval)
+            )
+            # 菜单脚本修改 urls.json 前发送 SIGUSR1，请求先合并日志
+            with contextlib.suppress(NotImplementedError, AttributeError):
+                asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.registry.request_compact)
+
+            # 多进程模式：启动工作进程
+            if self.worker_pool:
+                await self.worker_pool.start()
+
+            # 可选的 /metrics 接口
+            if self.metrics_port:
+                await self.start_metrics_server()
             
             # 发送启动通知
             await self.send_telegram_notification(
@@ -445,18 +3707,44 @@ class VPSMonitor:
             
             # 启动时进行初始检查
             urls_dict = self.load_urls()
-            if urls_dict:
+            if urls_dict and self.cluster:
+                # 集群模式：启动检查也按租约分配，由调度循环完成，避免各节点重复检查和通知
+                self.logger.info(f"集群模式（节点 {self.node_id}），按租约检查 {len(urls_dict)} 个商品")
+            elif urls_dict and self.warm_start:
+                # 热启动：沿用上次保存的状态，只重新检查已过期的商品，状态变化时才通知
+                stale_urls = {
+                    url: name for url, name in urls_dict.items()
+                    if time.time() - self.last_check.get(url, 0) >= self.check_interval
+                }
+                await self.send_telegram_notification(
+                    f"♻️ 已恢复上次的监控状态（{len(urls_dict) - len(stale_urls)} 个商品状态仍有效），"
+                    f"正在重新检查 {len(stale_urls)} 个商品..."
+                )
+                results = await self.run_check_cycle(stale_urls)
+                for url, name in stale_urls.items():
+                    try:
+                        stock_available, error = results[url]
+                        await self.process_result(url, name, stock_available, error)
+                    except Exception as e:
+                        self.logger.error(f"初始检查URL {url} 时出错: {str(e)}")
+                await self.flush_state()
+                self.notifier.flush_digests()
+            elif urls_dict:
                 await self.send_telegram_notification("🔄 正在进行启动检查...")
+                results = await self.run_check_cycle(urls_dict)
                 for url, name in urls_dict.items():
                     try:
-                        stock_available, error = await self.check_stock(url)
+                        stock_available, error = results[url]
                         if error:
+                            self.record_state(url, stock_available, error)
                             await self.send_telegram_notification(
                                 f"📦 产品：{name}\n"
                                 f"🔗 链接：{url}\n"
                                 f"❗ 检查失败: {error}\n"
                                 "将在下一个检查周期重试\n\n"
-                                "使用 /list 命令查看所有监控商品"
+                                "使用 /list 命令查看所有监控商品",
+                                digest=True,
+                                chats=self.registry.get_subscribers(url)
                             )
                         else:
                             status = "🟢 有货" if stock_available else "🔴 无货"
@@ -464,90 +3752,69 @@ class VPSMonitor:
                                 f"📦 产品：{name}\n"
                                 f"🔗 链接：{url}\n"
                             )
-                            if url in self.product_configs:
-                                message += f"⚙️ 配置：{self.product_configs[url].get('配置', '')}\n"
+                            config_info = self.registry.get_config(url)
+                            if config_info:
+                                message += f"⚙️ 配置：{config_info}\n"
                             message += f"📊 当前状态：{status}"
-                            await self.send_telegram_notification(message)
+                            await self.send_telegram_notification(
+                                message, digest=True, chats=self.registry.get_subscribers(url)
+                            )
                             # 记录初始状态
                             self.stock_status[url] = stock_available
                             self.notification_count[url] = 0
+                            self.record_state(url, stock_available, error)
                     except Exception as e:
                         self.logger.error(f"初始检查URL {url} 时出错: {str(e)}")
                         continue
+                await self.flush_state()
+                # 启动检查结果合并成摘要发送
+                self.notifier.flush_digests()
                 
                 await self.send_telegram_notification("✅ 启动检查完成")
             
-            # 保持程序运行
+            # 保持程序运行：每个URL按各自的到期时间检查
+            self.scheduler.sync(self.registry_entries(), self.last_check)
+            page_groups = self.page_groups()
+            registry_version = self.registry.version
             while True:
                 try:
-                    # 加载URL列表
-                    urls_dict = self.load_urls()
-                    if not urls_dict:
-                        self.logger.info("没有要监控的URL")
-                        await asyncio.sleep(self.check_interval)
-                        continue
+                    if self.registry.version != registry_version:
+                        registry_version = self.registry.version
+                        self.scheduler.sync(self.registry_entries(), self.last_check)
+                        page_groups = self.page_groups()
+
+                    # 稍微提前取出即将到期的URL，合并成一批检查
+                    due_urls = [
+                        url for url in self.scheduler.pop_due(time.time() + self.dispatch_window)
+                        if url not in self.in_flight
+                    ]
+                    # 共用同一页面的其他商品一起检查，页面只下载一次
+                    for fetch_url in {self.clean_url(url) for url in due_urls}:
+                        for sibling in page_groups.get(fetch_url, ()):
+                            if sibling not in due_urls and sibling not in self.in_flight and self.scheduler.take(sibling):
+                                due_urls.append(sibling)
+                    if due_urls:
+                        self.in_flight.update(due_urls)
+                        batch = asyncio.create_task(self.run_batch(due_urls))
+                        self.batch_tasks.add(batch)
+                        batch.add_done_callback(self.batch_tasks.discard)
 
-                    for url, name in urls_dict.items():
-                        try:
-                            stock_available, error = await self.check_stock(url)
-                            
-                            if error:
-                                # 如果检查出错，记录错误但继续监控
-                                self.logger.error(f"检查URL {url} 时出错: {error}")
-                                await self.send_telegram_notification(
-                                    f"📦 产品：{name}\n"
-                                    f"🔗 链接：{url}\n"
-                                    f"❗ 检查失败: {error}\n"
-                                    "将在下一个检查周期重试"
-                                )
-                                continue
-                                
-                            # 初始化状态
-                            if url not in self.stock_status:
-                                self.stock_status[url] = stock_available
-                                self.notification_count[url] = 0
-                                continue
-                            
-                            # 状态变化检测和通知逻辑
-                            if stock_available != self.stock_status[url]:
-                                message = (
-                                    f"📦 产品：{name}\n"
-                                    f"🔗 链接：{url}\n"
-                                )
-                                if url in self.product_configs:
-                                    config_info = self.product_configs[url].get('配置', '')
-                                    message += f"⚙️ 配置：{config_info}\n"
-                                
-                                if stock_available:
-                                    # 从无货变为有货
-                                    message += "📊 状态：🟢 补货啦！商品已经有货"
-                                    self.notification_count[url] = 1
-                                else:
-                                    # 从有货变为无货
-                                    message += "📊 状态：🔴 已经无货"
-                                    self.notification_count[url] = 0
-                                
-                                await self.send_telegram_notification(message)
-                                self.stock_status[url] = stock_available
-                            
-                            # 持续有货的通知逻辑（最多通知3次）
-                            elif stock_available and self.notification_count[url] < 3:
-                                message = (
-                                    f"📦 产品：{name}\n"
-                                    f"🔗 链接：{url}\n"
-                                )
-                                if url in self.product_configs:
-                                    config_info = self.product_configs[url].get('配置', '')
-                                    message += f"⚙️ 配置：{config_info}\n"
-                                message += f"📊 状态：🟢 仍然有货 (通知 {self.notification_count[url] + 1}/3)"
-                                await self.send_telegram_notification(message)
-                                self.notification_count[url] += 1
-
-                        except Exception as e:
-                            self.logger.error(f"检查URL {url} 时出错: {str(e)}")
-                            continue
-
-                    await asyncio.sleep(self.check_interval)
+                    next_due = self.scheduler.next_due()
+                    if next_due is None:
+                        if not self.registry.by_url:
+                            self.logger.info("没有要监控的URL")
+                        wait = self.urls_reload_interval
+                    else:
+                        wait = next_due - time.time()
+                    # 最长等待 urls_reload_interval，及时处理监控列表的变化；一批检查完成时提前唤醒
+                    self.dispatch_event.clear()
+                    try:
+                        await asyncio.wait_for(
+                            self.dispatch_event.wait(),
+                            min(max(wait, self.dispatch_window), self.urls_reload_interval)
+                        )
+                    except asyncio.TimeoutError:
+                        pass
                 except Exception as e:
                     self.logger.error(f"监控循环出错: {str(e)}")
                     await asyncio.sleep(60)  # 出错后等待1分钟再继续
@@ -557,141 +3824,101 @@ class VPSMonitor:
             raise
         finally:
             # 清理资源
+            if self.notifier_task:
+                await self.notifier.drain(5)
+                self.notifier_task.cancel()
             try:
                 if self.app:
-                    await self.app.updater.stop()
+                    if self.app.updater.running:
+                        await self.app.updater.stop()
                     await self.app.stop()
                     await self.app.shutdown()
             except Exception as e:
                 self.logger.error(f"关闭应用时出错: {str(e)}")
+            if self.registry_task:
+                self.registry_task.cancel()
+                await asyncio.gather(self.registry_task, return_exceptions=True)
+            await self.registry.close()
+            await self.watchdog.stop()
+            for batch in list(self.batch_tasks):
+                batch.cancel()
+            # 退出前保存尚未写入的状态和检查历史
+            await self.flush_state()
+            await self.save_history()
+            await self.save_clearances()
+            if self.worker_pool:
+                await self.worker_pool.close()
+            if self.cluster:
+                await self.cluster.close()
+            if self.metrics_runner:
+                await self.metrics_runner.cleanup()
+            if self.http_session:
+                await self.http_session.close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.state_store.close()
 
     def load_urls(self):
-        """从JSON文件加载URL数据"""
-        urls_dict = {}
+        """获取当前监控列表 {URL: 名称}（读取内存索引，不访问磁盘）"""
+        return self.registry.snapshot()
+
+    async def subscribe_url(self, name, url, chat_id, config=None):
+        """为聊天订阅URL，返回 (是否成功, 消息, 是否新建条目)"""
         try:
-            try:
-                with open(self.urls_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for id_str, info in data.items():
-                        url = info.get('URL', '')
-                        if url:
-                            urls_dict[url] = info.get('名称', '')
-                            self.product_names[url] = info.get('名称', '')
-                            if info.get('配置'):
-                                self.product_configs[url] = {'配置': info.get('配置')}
-                    
-                    self.logger.info(f"成功加载 {len(urls_dict)} 个URL")
-            except FileNotFoundError:
-                self.logger.info("URL文件不存在，将创建新文件")
-                with open(self.urls_file, 'w', encoding='utf-8') as f:
-                    json.dump({}, f, ensure_ascii=False, indent=4)
-            
-            return urls_dict
-                    
+            _, created = await self.registry.subscribe(name, url, chat_id, config)
+            return True, "保存成功", created
         except Exception as e:
-            self.logger.error(f"加载URL文件时出错: {str(e)}")
-            return {}
+            self.logger.error(f"保存URL失败: {str(e)}")
+            return False, f"保存失败: {str(e)}", False
 
-    def save_url(self, name, url, config=None):
-        """保存URL到JSON文件"""
+    async def unsubscribe_url(self, url, chat_id):
+        """取消聊天对URL的订阅，没有订阅者时停止监控该URL"""
         try:
-            # 读取现有数据
-            try:
-                with open(self.urls_file, 'r') as f:
-                    data = json.load(f)
-            except (FileNotFoundError, json.JSONDecodeError):
-                data = {}
-            
-            # 检查URL是否已存在
-            url_exists = False
-            existing_id = None
-            for id_str, info in data.items():
-                if info.get('URL') == url:
-                    url_exists = True
-                    existing_id = id_str
-                    break
-            
-            if url_exists:
-                # 更新现有记录
-                data[existing_id] = {
-                    "名称": name,
-                    "URL": url,
-                    "配置": config if config else ""
-                }
-            else:
-                # 添加新记录
-                new_id = str(len(data) + 1)
-                data[new_id] = {
-                    "名称": name,
-                    "URL": url,
-                    "配置": config if config else ""
-                }
-            
-            # 保存到文件
-            with open(self.urls_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-            
-            # 更新内存中的数据
-            self.product_names[url] = name
-            if config:
-                self.product_configs[url] = {'配置': config}
-            
-            return True, "保存成功"
+            removed = await self.registry.unsubscribe(url, chat_id)
+            if removed is None:
+                return False, "未找到该URL"
+            if removed:
+                return await self.remove_url(url)
+            return True, "删除成功"
         except Exception as e:
-            self.logger.error(f"保存URL失败: {str(e)}")
-            return False, f"保存失败: {str(e)}"
+            self.logger.error(f"删除URL失败: {str(e)}")
+            return False, f"删除失败: {str(e)}"
 
-    def remove_url(self, url):
+    async def remove_url(self, url):
         """从JSON文件中删除URL"""
         try:
-            # 读取现有数据
-            with open(self.urls_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # 查找并删除URL
-            target_id = None
-            for id_str, info in data.items():
-                if info.get('URL') == url:
-                    target_id = id_str
-                    break
-            
-            if target_id:
-                del data[target_id]
-                
-                # 保存更新后的数据
-                with open(self.urls_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=4)
-                
-                # 清理内存中的数据
-                if url in self.product_names:
-                    del self.product_names[url]
-                if url in self.product_configs:
-                    del self.product_configs[url]
-                if url in self.stock_status:
-                    del self.stock_status[url]
-                if url in self.notification_count:
-                    del self.notification_count[url]
-                
-                return True, "删除成功"
-            else:
+            if await self.registry.remove(url) is None:
                 return False, "未找到该URL"
-                
+
+            # 清理内存中的数据
+            if url in self.stock_status:
+                del self.stock_status[url]
+            if url in self.notification_count:
+                del self.notification_count[url]
+            self.last_check.pop(url, None)
+            self.dirty_state.pop(url, None)
+            self.verdicts.pop(url, None)
+            self.history.remove(url)
+            self.response_cache.remove(self.clean_url(url))
+            # 和其它状态写入一样放到线程池，SQLite 提交不阻塞事件循环
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.state_store.delete, url)
+
+            return True, "删除成功"
         except Exception as e:
             self.logger.error(f"删除URL失败: {str(e)}")
             return False, f"删除失败: {str(e)}"
 
-    async def send_telegram_notification(self, message):
-        """发送Telegram通知"""
+    async def send_telegram_notification(self, message, digest=False, chats=None):
+        """发送Telegram通知（只排队，不等待发送完成）
+
+        digest=True 的消息会在本轮检查结束后按聊天合并成摘要发送；
+        chats 为接收的聊天ID列表（商品的订阅者），默认只发给 config.json 中的 chat_id
+        """
         try:
-            if not self.app:
-                self.logger.error("Telegram Bot 未初始化")
-                return
-                
-            await self.app.bot.send_message(
-                chat_id=self.chat_id,
-                text=message
-            )
-            self.logger.info("Telegram 通知发送成功")
+            for chat_id in (chats if chats is not None else [self.chat_id]):
+                if digest:
+                    self.notifier.add_to_digest(chat_id, message)
+                else:
+                    self.notifier.send(chat_id, message)
         except Exception as e:
             self.logger.error(f"发送Telegram通知失败: {str(e)}")
 
@@ -701,33 +3928,329 @@ class VPSMonitor:
             with open(self.config_file, 'r') as f:
                 config = json.load(f)
                 self.bot_token = config['bot_token']
-                self.chat_id = config['chat_id']
+                # 管理员聊天：接收程序状态通知，并拥有未设置订阅的商品
+                self.chat_id = str(config['chat_id'])
                 self.check_interval = config.get('check_interval', 300)
+                # 全局并发检查数
+                self.max_workers = max(1, int(config.get('max_workers', 10)))
+                # 每轮检查的时间预算（秒），超时未完成的检查会被取消
+                self.cycle_timeout = config.get('cycle_timeout', self.check_interval)
+                # 按主机的限流配置，"default" 为默认值，其余键为主机名
+                self.host_limits = config.get('host_limits', {})
+                # 单个页面最多下载的字节数，0 表示不限制
+                self.max_page_bytes = int(config.get('max_page_bytes', 2 * 1024 * 1024))
+                # 读到明确的缺货标志后提前结束下载
+                self.early_verdict = config.get('early_verdict', True)
+                # 检查 urls.json 是否被外部修改的间隔（秒）
+                self.urls_reload_interval = config.get('urls_reload_interval', 5)
+                # 机器人的修改合并进 urls.json 的最长等待时间（秒），之前只追加到日志文件
+                self.urls_compact_interval = config.get('urls_compact_interval', 30)
+                # 库存状态数据库文件
+                self.state_file = config.get('state_file', 'state.db')
+                # 自适应检查间隔：状态刚变化或页面经常变动时加快，长期稳定或持续失败时放慢
+                self.adaptive_interval = config.get('adaptive_interval', True)
+                self.min_interval = config.get('min_interval', max(30, self.check_interval / 5))
+                self.max_interval = config.get('max_interval', self.check_interval * 6)
+                # 到期时间相差不超过该值（秒）的URL合并成一批检查
+                self.dispatch_window = config.get('dispatch_window', 1)
+                # Cloudflare 通行凭证缓存文件
+                self.clearance_file = config.get('clearance_file', 'cf_clearance.json')
+                # 请求方式：auto 先用 aiohttp，遇到 Cloudflare 挑战再改用 cloudscraper；cloudscraper 始终使用 cloudscraper
+                self.http_backend = config.get('http_backend', 'auto')
+                # 按锚点截取商品片段时，片段的最大长度（字符）
+                self.section_length = config.get('section_length', 2000)
+                # /metrics 接口的监听地址和端口，端口为 0 时不启动
+                self.metrics_host = config.get('metrics_host', '127.0.0.1')
+                self.metrics_port = int(config.get('metrics_port', 0))
+                # 工作进程数，0 表示在本进程内检查
+                self.worker_processes = max(0, int(config.get('worker_processes', 0)))
+                # 集群模式：多个节点共用的协调存储（SQLite 文件路径或 redis://），为空时不启用
+                self.cluster_store = config.get('cluster_store', '')
+                self.node_id = config.get('node_id') or socket.gethostname()
+                # 是否接收 Bot 命令，同一个 Bot 只能由一个节点轮询
+                self.telegram_polling = config.get('telegram_polling', True)
+                # 单个回调阻塞事件循环超过该时长（秒）时记录调用栈
+                self.loop_lag_threshold = config.get('loop_lag_threshold', 0.5)
+                # 每个商品在内存中保留的检查记录条数
+                self.history_size = int(config.get('history_size', 128))
+                # 主机熔断：连续失败的页面数、首次暂停时间和最长暂停时间（秒）
+                self.breaker_threshold = int(config.get('breaker_threshold', 3))
+                self.breaker_backoff = config.get('breaker_backoff', 60)
+                self.breaker_max_backoff = config.get('breaker_max_backoff', 1800)
         except Exception as e:
             self.logger.error(f"加载配置文件失败: {str(e)}")
             exit(1)
 
+class ShardWorker(VPSMonitor):
+    """多进程模式的工作进程：只下载和判断协调进程分配的页面，不连接 Telegram、不保存库存状态"""
+
+    METRICS_INTERVAL = 5  # 上报指标的间隔（秒）
+
+    def __init__(self, index, conn):
+        self.index = index
+        self.conn = conn
+        self.logger = logging.getLogger(f"{__name__}.shard{index}")
+        self.urls_file = 'urls.json'
+        self.config_file = 'config.json'
+        self.load_config()
+        # 各进程负责的主机不同，Cloudflare 凭证分文件保存，避免互相覆盖
+        root, ext = os.path.splitext(self.clearance_file)
+        self.clearance_file = f"{root}.shard{index}{ext}"
+        self.metrics = Metrics()
+        self.worker_pool = None
+        self.setup_fetching()
+        # 只用于读取商品的锚点和选择器设置
+        self.registry = URLRegistry(self.urls_file, self.logger, read_only=True)
+        self.registry.load()
+        self.tasks = {}  # 请求ID -> 检查任务
+        self.stopped = asyncio.Event()
+
+    def on_message(self):
+        try:
+            message = self.conn.recv()
+        except (EOFError, OSError):
+            # 协调进程已退出
+            self.stopped.set()
+            return
+        kind = message[0]
+        if kind == 'check':
+            _, request_id, fetch_url, urls = message
+            task = asyncio.create_task(self.handle_check(request_id, fetch_url, urls))
+            self.tasks[request_id] = task
+            task.add_done_callback(lambda _: self.tasks.pop(request_id, None))
+        elif kind == 'cancel':
+            task = self.tasks.get(message[1])
+            if task:
+                task.cancel()
+        elif kind == 'stop':
+            self.stopped.set()
+
+    async def handle_check(self, request_id, fetch_url, urls):
+        # 菜单脚本或协调进程修改了 urls.json 时重新读取锚点和选择器
+        self.registry.refresh()
+        results = await self.check_page(fetch_url, urls)
+        record = self.fetch_records.pop(fetch_url, None)
+        self.conn.send(('result', request_id, results, self.response_cache.pop_changed(fetch_url), record))
+
+    async def report_metrics(self):
+        while True:
+            await asyncio.sleep(self.METRICS_INTERVAL)
+            self.conn.send(('metrics', self.metrics.samples))
+            await self.save_clearances()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.conn.fileno(), self.on_message)
+        reporter = asyncio.create_task(self.report_metrics())
+        self.conn.send(('ready',))
+        try:
+            await self.stopped.wait()
+        finally:
+            loop.remove_reader(self.conn.fileno())
+            reporter.cancel()
+            for task in list(self.tasks.values()):
+                task.cancel()
+            await asyncio.gather(reporter, *self.tasks.values(), return_exceptions=True)
+            await self.save_clearances()
+            if self.http_session:
+                await self.http_session.close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+def run_shard_worker(index, conn, log_queue):
+    """工作进程入口"""
+    # Ctrl+C 由协调进程处理，工作进程等待 stop 消息后退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(log_queue)
+    try:
+        asyncio.run(ShardWorker(index, conn).run())
+    except Exception as e:
+        logging.getLogger(__name__).error(f"工作进程 {index} 出错: {str(e)}")
+        raise
+
+class RepeatFilter(logging.Filter):
+    """限制重复日志：同一条警告/错误在 interval 秒内只写一次，下一次写入时附上期间省略的次数
+
+    按商品的检查失败每个周期都会原样重复，压住这些行可以让日志在大量商品出错时仍然可读。
+    """
+
+    MAX_KEYS = 10000  # 记录的不同消息数上限，超出时清理已过期的
+
+    def __init__(self, interval, level=logging.WARNING):
+        super().__init__()
+        self.interval = interval
+        self.level = level
+        self.seen = {}  # (记录器, 级别, 消息) -> [上次写入时间, 省略次数]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.interval <= 0 or record.levelno < self.level:
+            return True
+        message = record.getMessage()
+        key = (record.name, record.levelno, message)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is not None and now - entry[0] < self.interval:
+                entry[1] += 1
+                return False
+            suppressed = entry[1] if entry is not None else 0
+            self.seen[key] = [now, 0]
+            if len(self.seen) > self.MAX_KEYS:
+                self.seen = {k: v for k, v in self.seen.items() if now - v[0] < self.interval}
+        if suppressed:
+            record.msg = f"{message}（过去 {self.interval:g} 秒内另有 {suppressed} 次相同记录）"
+            record.args = None
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """把日志放入有界队列，由后台线程写入；队列满时丢弃并在下一条日志中说明丢弃数量，绝不阻塞调用方"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if self.dropped:
+            record.msg = f"{record.msg}（日志队列已满，之前丢弃了 {self.dropped} 条）"
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.dropped = 0
+
+class LogForwarder(logging.Handler):
+    """把工作进程发来的日志交给本进程的日志管道，只由主进程写日志文件"""
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+class JsonLogFormatter(logging.Formatter):
+    """每行一个 JSON 对象，便于日志系统采集"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.processName
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def compress_rotated_log(source, dest):
+    """轮转时把旧日志压缩为 .gz"""
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+LOG_DEFAULTS = {
+    'log_file': 'monitor.log',
+    'log_max_bytes': 10 * 1024 * 1024,
+    'log_rotate_when': '',
+    'log_backup_count': 5,
+    'log_compress': True,
+    'log_format': 'text',
+    'log_repeat_interval': 300,
+    'log_queue_size': 10000
+}
+
+def load_logging_config(config_file='config.json'):
+    """读取 config.json 中的日志配置，文件缺失或格式错误时使用默认值（由 VPSMonitor 报告配置错误）"""
+    settings = dict(LOG_DEFAULTS)
+    try:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        settings.update({key: config[key] for key in LOG_DEFAULTS if key in config})
+    except (OSError, ValueError):
+        pass
+    return settings
+
+def setup_logging(worker_queue=None):
+    """配置日志记录
+
+    所有日志先经重复限制后放入队列，由后台线程写入文件（按大小或时间轮转并压缩）和终端，
+    事件循环线程不做磁盘 I/O。worker_queue 不为空时为工作进程：日志经该队列交给主进程写入。
+    返回后台写入的 QueueListener（工作进程返回 None），退出前调用 stop() 写完剩余日志。
+    """
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    if worker_queue is not None:
+        root.addHandler(logging.handlers.QueueHandler(worker_queue))
+        return None
+
+    settings = load_logging_config()
+    if settings['log_format'] == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if settings['log_rotate_when']:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            settings['log_file'], when=settings['log_rotate_when'],
+            backupCount=int(settings['log_backup_count']), encoding='utf-8'
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            settings['log_file'], maxBytes=int(settings['log_max_bytes']),
+            backupCount=int(settings['log_backup_count']), encoding='utf-8'
+        )
+    if settings['log_compress']:
+        file_handler.rotator = compress_rotated_log
+        file_handler.namer = lambda name: name + '.gz'
+    handlers = [file_handler]
+    # 后台运行时（如菜单脚本的 nohup）终端输出没有人看，只写日志文件
+    if sys.stderr is not None and sys.stderr.isatty():
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=int(settings['log_queue_size']))
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RepeatFilter(float(settings['log_repeat_interval'])))
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
 async def main():
     """主程序入口"""
-    # 配置日志记录
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler('monitor.log', encoding='utf-8'),
-            logging.StreamHandler()
-        ]
-    )
+    listener = setup_logging()
     logger = logging.getLogger(__name__)
+    # SIGTERM（menu.sh 停止机器人）和 SIGINT 取消主任务，让 monitor() 的清理流程保存状态后再退出
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    stopping = []
+
+    def request_stop(signame):
+        if stopping:
+            return
+        stopping.append(signame)
+        logger.info(f"收到 {signame}，正在保存状态并退出...")
+        main_task.cancel()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, request_stop, sig.name)
 
     try:
         monitor = VPSMonitor()
         await monitor.monitor()
     except KeyboardInterrupt:
         logger.info("程序被用户中断")
+    except asyncio.CancelledError:
+        if not stopping:
+            raise
+        logger.info(f"程序已停止（{stopping[0]}）")
     except Exception as e:
         logger.error(f"程序发生错误: {str(e)}")
         raise
+    finally:
+        # 等后台线程写完队列中剩余的日志
+        listener.stop()
 
 if __name__ == '__main__':
     try: